@@ -0,0 +1,224 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import fcntl
+import hashlib
+import os
+
+import numpy as np
+
+from scipy.sparse import csr_matrix
+
+
+class DistanceCache(object):
+    """Class for caching distance matrices of habitats on disk so they
+    survive restarts of the kernel and can be shared between processes.
+    Entries are addressed by a sha1 hash of the node positions, the graph
+    laplacian (which stores the topology and migration rates) and the
+    query e.g. the method and tolerance of coal_dist. They are stored as
+    .npy files which are loaded memory mapped and read only. When the
+    cache grows beyond max_bytes the least recently used entries are
+    removed
+
+    Arguments
+    ---------
+    path : str
+        directory storing the cache
+    max_bytes : int
+        maximum total size of the cached arrays
+
+    Attributes
+    ----------
+    path : str
+        directory storing the cache
+    max_bytes : int
+        maximum total size of the cached arrays
+    """
+    def __init__(self, path, max_bytes=2 ** 30):
+
+        # directory storing the cache
+        self.path = path
+
+        # maximum size of the cache
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def key(self, hab, query):
+        """Hashes a habitat and a query
+
+        Arguments:
+            hab : Habitat
+                habitat object
+            query : tuple
+                name of the distance and its arguments
+
+        Returns:
+            key : str
+                sha1 hex digest
+        """
+        h = hashlib.sha1()
+        h.update(repr(query).encode("utf-8"))
+
+        if hab.s is not None:
+            h.update(np.ascontiguousarray(hab.s, dtype=np.float64).tobytes())
+
+        if hab.l is not None:
+            # canonical sparse form so equal matrices hash equally
+            l = csr_matrix(hab.l, dtype=np.float64)
+            l.sum_duplicates()
+            l.sort_indices()
+            h.update(np.int64(l.shape[0]).tobytes())
+            h.update(l.indptr.astype(np.int64).tobytes())
+            h.update(l.indices.astype(np.int64).tobytes())
+            h.update(l.data.tobytes())
+
+        return(h.hexdigest())
+
+    def fetch(self, hab, query, func):
+        """Loads a cached distance matrix or computes and stores it
+
+        Arguments:
+            hab : Habitat
+                habitat object
+            query : tuple
+                name of the distance and its arguments
+            func : callable
+                computes the distance matrix if it is not cached
+
+        Returns:
+            r : array
+                read only distance matrix
+        """
+        key = self.key(hab, query)
+        r = self.get(key)
+        if r is None:
+            # read only like the memory mapped arrays of cache hits
+            r = np.asarray(func())
+            r.flags.writeable = False
+            self.put(key, r)
+
+        return(r)
+
+    def get(self, key):
+        """Loads a cached array
+
+        Arguments:
+            key : str
+                hash of the entry
+
+        Returns:
+            r : array
+                read only memory mapped array or None if not cached
+        """
+        f = self._file(key)
+        try:
+            r = np.load(f, mmap_mode="r")
+
+            # mark as recently used
+            os.utime(f, None)
+        except (IOError, OSError):
+            r = None
+
+        return(r)
+
+    def put(self, key, r):
+        """Stores an array and evicts the least recently used entries if
+        the cache is too large
+
+        Arguments:
+            key : str
+                hash of the entry
+            r : array
+                array to cache
+        """
+        f = self._file(key)
+        with self._lock():
+            # write then rename so readers never see a partial file
+            tmp = "{}.{}.tmp".format(f, os.getpid())
+            with open(tmp, "wb") as fh:
+                np.save(fh, np.asarray(r))
+            os.rename(tmp, f)
+
+            self._evict()
+
+    def clear(self):
+        """Removes all cached arrays
+        """
+        with self._lock():
+            for f in self._entries():
+                os.remove(f)
+
+    def _file(self, key):
+        """Path of a cached array
+
+        Arguments:
+            key : str
+                hash of the entry
+
+        Returns:
+            f : str
+                path of the .npy file
+        """
+        return(os.path.join(self.path, "{}.npy".format(key)))
+
+    def _entries(self):
+        """Paths of all cached arrays
+
+        Returns:
+            files : list
+                paths of the .npy files
+        """
+        files = [os.path.join(self.path, f) for f in os.listdir(self.path)
+                 if f.endswith(".npy")]
+
+        return(files)
+
+    def _evict(self):
+        """Removes the least recently used arrays until the cache fits
+        in max_bytes
+        """
+        stats = []
+        for f in self._entries():
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            stats.append((st.st_mtime, st.st_size, f))
+
+        stats.sort()
+        total = sum(size for _, size, _ in stats)
+        for _, size, f in stats:
+            if total <= self.max_bytes:
+                break
+            os.remove(f)
+            total -= size
+
+    def _lock(self):
+        """Exclusive lock of the cache directory shared between processes
+
+        Returns:
+            lock : _FileLock
+                context manager holding the lock
+        """
+        return(_FileLock(os.path.join(self.path, ".lock")))
+
+
+class _FileLock(object):
+    """Context manager holding an exclusive flock on a file
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fh = None
+
+    def __enter__(self):
+        self.fh = open(self.path, "a")
+        fcntl.flock(self.fh.fileno(), fcntl.LOCK_EX)
+
+        return(self)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fh.fileno(), fcntl.LOCK_UN)
+        self.fh.close()
@@ -11,10 +11,13 @@ from matplotlib import cm
 
 import msprime
 from sklearn.decomposition import PCA
+from scipy.sparse import issparse
 from scipy.spatial.distance import pdist, squareform
 
+import json
 import pickle as pkl
 import os
+from multiprocessing import Pool
 
 
 class GenotypeSimulator(object):
@@ -27,7 +30,9 @@ class GenotypeSimulator(object):
     hab : Habitat
         habitat object
     sim_path: str
-        path to simulation pkl file
+        path to the simulation file which stores the genotypes bit packed,
+        see PackedGenotypes, files pickled by earlier versions are loaded
+        as before
     chrom_length: float
         length of chrom to simulate
     mu: float
@@ -38,6 +43,23 @@ class GenotypeSimulator(object):
         number of indepdent regions to simulate from
     eps: float
         min derived allele frequency for filtering out rare variants
+    seed: int
+        master seed from which the seed of each shard is derived
+    n_jobs: int
+        if given the shards of replicates are simulated in a pool of
+        n_jobs processes otherwise they are simulated in this process
+    shard_size: int
+        number of replicates per shard which does not depend on n_jobs so
+        the genotypes for a given seed do not depend on the number of
+        processes
+    stream: bool
+        if True the simulation is not run when the object is created but
+        by iterating over simulate_chunks
+    store_path: str
+        if given the genotypes are assembled in a memory mapped file
+    online_filter: bool
+        if True rare variants are filtered out of each region or shard as
+        it is simulated so they are never stored
 
     Attributes
     ----------
@@ -53,17 +75,32 @@ class GenotypeSimulator(object):
         number of indepdent regions to simulate from
     eps: float
         min derived allele frequency for filtering out rare variants
+    seed: int
+        master seed from which the seed of each shard is derived
+    n_jobs: int
+        number of processes simulating shards
+    shard_size: int
+        number of replicates per shard
+    store : GenotypeStore
+        snp blocks of the simulation
+    packed : PackedGenotypes
+        memory mapped genotypes if they were loaded from sim_path
+    online_filter: bool
+        if True rare variants are filtered out during the simulation
+    sfs_discarded : array
+        n + 1 site frequency spectrum of the sites filtered out during the
+        simulation
     y : array
-        n x p genotype matrix
-    tree_sequences :
-        geneologies object
+        n x p genotype matrix which is merged from store or unpacked if
+        the genotypes were loaded from sim_path on first access
     n : int
         number of individuals
     p : int
         number of snps
     """
     def __init__(self, hab, sim_path, chrom_length=1, mu=1e-3, n_e=1,
-                 n_samp=10, n_rep=1e4, eps=.05):
+                 n_samp=10, n_rep=1e4, eps=.05, seed=None, n_jobs=None,
+                 shard_size=100, stream=False, store_path=None, online_filter=False):
 
         # habitat object
         self.hab = hab
@@ -86,70 +123,200 @@ class GenotypeSimulator(object):
         # min derived allele frequency to filter out
         self.eps = eps
 
+        # master seed
+        self.seed = seed
+
+        # number of processes
+        self.n_jobs = n_jobs
+
+        # replicates per shard
+        self.shard_size = shard_size
+
+        # path to simulation file
+        self.sim_path = sim_path
+
+        # genotype matrix
+        self._y = None
+
+        # memory mapped genotypes loaded from the simulation file
+        self.packed = None
+
+        # path of the memory mapped genotype store
+        self.store_path = store_path
+
+        # snp blocks of the simulation
+        self.store = None
+
+        # filter rare variants during the simulation
+        self.online_filter = online_filter
+
+        # sfs of the filtered out sites
+        self.sfs_discarded = None
+
         # if the simulation was already performed extract genotypes
-        if os.path.exists(sim_path):
+        if os.path.exists(sim_path) and PackedGenotypes.is_packed(sim_path):
+            self.packed = PackedGenotypes(sim_path)
+            self._set_samples(self.packed.n, self.packed.p)
+        elif os.path.exists(sim_path):
             with open(sim_path, 'rb') as geno:
                 self.y = pkl.load(geno)
+            self._set_samples(*self.y.shape)
         # otherwise run the simulation
-        else:
-            # simulate geneologies from the defined model
-            self._simulate_trees()
-            self._simulate_genotypes()
-            with open(sim_path, 'wb') as geno:
-                pkl.dump(self.y, geno)
+        elif not stream:
+            for _ in self.simulate_chunks():
+                pass
 
-        # number of snps
-        self.n, self.p = self.y.shape
+    @property
+    def y(self):
+        """n x p genotype matrix
+        """
+        if self._y is None and self.store is not None:
+            self._y = self.store.y
+        elif self._y is None and self.packed is not None:
+            self._y = self.packed.genotypes()
 
-        # node ids for each individual
-        self.v = np.repeat(self.hab.v, int(self.n / self.hab.d)).T
+        return(self._y)
 
-        # spatial positions for each individual
-        self.s = np.vstack([np.repeat(self.hab.s[:,0], int(self.n / self.hab.d)),
-                            np.repeat(self.hab.s[:,1], int(self.n / self.hab.d))]).T
+    @y.setter
+    def y(self, y):
+        self._y = y
 
-    def _simulate_trees(self):
-        """Simulate trees under the coalescent migration model
-        defined in the habitat with constant population
-        sizes
+    def snp_range(self, start, stop):
+        """Genotypes of a range of snps which are only unpacked for the
+        range if the genotypes were loaded from sim_path
+
+        Arguments:
+            start : int
+                first snp
+            stop : int
+                snp after the last snp
+
+        Returns:
+            y : array
+                n x (stop - start) genotype matrix
         """
-        # simulate trees
-        population_configurations = [msprime.PopulationConfiguration(sample_size=self.n_samp) for _ in range(self.hab.d)]
-        self.tree_sequences = msprime.simulate(population_configurations=population_configurations,
-                                               migration_matrix=self.hab.m.tolist(),
-                                               length=self.chrom_length,
-                                               mutation_rate=self.mu,
-                                               num_replicates=self.n_rep,
-                                               Ne=self.n_e)
+        if self._y is None and self.packed is not None:
+            y = self.packed.genotypes(start, stop)
+        else:
+            y = self.y[:, start:stop]
+
+        return(y)
+
+    def _params(self):
+        """Parameters of the simulation stored with the genotypes
 
-    def _simulate_genotypes(self):
-        """Extract trees and simulate mutations in each
-        independent region to obtain a genotype matrix
+        Returns:
+            params : dict
+                simulation parameters
         """
-        # extract mutations
-        genotypes = []
+        params = {"d": int(self.hab.d), "chrom_length": float(self.chrom_length),
+                  "mu": float(self.mu), "n_e": float(self.n_e),
+                  "n_samp": int(self.n_samp), "n_rep": int(self.n_rep),
+                  "eps": float(self.eps), "online_filter": bool(self.online_filter),
+                  "seed": None if self.seed is None else int(self.seed)}
 
-        # loop through each region
-        for i,tree_sequence in enumerate(self.tree_sequences):
+        return(params)
 
-            if i % 250 == 0:
-                print('extracting tree {}'.format(i))
+    def _set_samples(self, n, p):
+        """Sets the number of individuals and snps and the node and
+        spatial position of each individual
 
-            shape = tree_sequence.get_num_mutations(), tree_sequence.get_sample_size()
-            g = np.empty(shape, dtype="u1")
+        Arguments:
+            n : int
+                number of individuals
+            p : int
+                number of snps
+        """
+        # number of snps
+        self.n, self.p = n, p
 
-            # loop through each tree
-            for variant in tree_sequence.variants():
-                g[variant.index] = variant.genotypes
+        # node ids for each individual
+        self.v = np.repeat(self.hab.v, int(self.n / self.hab.d)).T
 
-            genotypes.append(g.T)
+        # spatial positions for each individual
+        self.s = np.vstack([np.repeat(self.hab.s[:,0], int(self.n / self.hab.d)),
+                            np.repeat(self.hab.s[:,1], int(self.n / self.hab.d))]).T
 
-        # (n*d) x p genotype matrix
-        self.y = np.hstack(genotypes)
-        print("n={},p={}".format(self.y.shape[0], self.y.shape[1]))
+    def simulate_chunks(self):
+        """Runs the simulation and yields the genotypes of each shard of
+        regions as soon as they are simulated. The snp blocks are appended
+        to a GenotypeStore whose chunks are only merged into the genotype
+        matrix on first access of y
+
+        Yields:
+            y_chunk : array
+                n x p_i genotype matrix of the region or shard
+        """
+        n = self.hab.d * self.n_samp
+        store = GenotypeStore(n, path=self.store_path)
+        if self.online_filter:
+            self.sfs_discarded = np.zeros(n + 1, dtype=np.int64)
+
+        # blocks are bit packed into the simulation file as they arrive
+        writer = _PackedWriter(self.sim_path, n)
+        try:
+            for g, sfs in self._shard_blocks():
+                if sfs is not None:
+                    self.sfs_discarded += sfs
+                store.append(g)
+                writer.append(g)
+                yield(g.T)
+        except BaseException:
+            writer.abort()
+            raise
+
+        writer.close(self._params())
+
+        # (n*d) x p genotype matrix is merged on first access
+        self.store = store
+        print("n={},p={}".format(store.n, store.p))
+
+        self._set_samples(store.n, store.p)
+
+    def _shard_blocks(self):
+        """Simulate replicates in shards of shard_size replicates in a
+        process pool or in this process if n_jobs is None. Each shard has
+        its own seed drawn from the master seed and the blocks are yielded
+        in the order of the shards
+
+        Yields:
+            g : array
+                p_i x n snp block of each shard
+            sfs : array
+                n + 1 sfs of the filtered out sites or None
+        """
+        # msprime expects a dense nested list
+        m = self.hab.m.toarray() if issparse(self.hab.m) else np.asarray(self.hab.m)
+
+        n_rep = int(self.n_rep)
+        n_shards = int(np.ceil(n_rep / self.shard_size))
+        seeds = np.random.RandomState(self.seed).randint(1, 2 ** 31 - 1, size=n_shards)
+
+        args = []
+        for k in range(n_shards):
+            n_rep_k = min(self.shard_size, n_rep - k * self.shard_size)
+            args.append((self.hab.d, self.n_samp, m.tolist(), self.chrom_length,
+                         self.mu, self.n_e, n_rep_k, int(seeds[k]),
+                         self.eps if self.online_filter else None))
+
+        if self.n_jobs is None:
+            # same shards and seeds as the pool
+            for shard_args in args:
+                yield(_simulate_shard(shard_args))
+            return
+
+        pool = Pool(self.n_jobs)
+        try:
+            # imap returns the blocks in the order of the shards
+            for block in pool.imap(_simulate_shard, args):
+                yield(block)
+        finally:
+            pool.terminate()
+            pool.join()
 
     def filter_rare_var(self):
-        """Filter out rare variants
+        """Filter out rare variants which is not needed if they were
+        filtered out during the simulation, see online_filter
         """
         daf = np.sum(self.y, axis=0) / self.n
         idx = np.where((daf >= self.eps) & (daf <= (1. - self.eps)))[0]
@@ -247,3 +414,387 @@ class GenotypeSimulator(object):
                 y[i,j] = x[v[i], v[j]]
 
         return(y)
+
+
+# magic number and size of the header of the packed genotype file
+_MAGIC = b"SRWGENO1"
+_HEADER_SIZE = 16
+
+
+class PackedGenotypes(object):
+    """Class for genotypes stored bit packed along the sample axis in a
+    memory mapped file so opening it does not read the genotypes and
+    ranges of snps are unpacked when they are accessed. The file starts
+    with a magic number and the offset of a json footer storing the shape,
+    the parameters of the simulation and the index of the chunks, i.e.
+    regions or shards, followed by p x ceil(n / 8) bytes of packed snps
+
+    Arguments
+    ---------
+    path : str
+        path of the file
+
+    Attributes
+    ----------
+    path : str
+        path of the file
+    n : int
+        number of individuals
+    p : int
+        number of snps
+    params : dict
+        parameters of the simulation
+    chunks : array
+        n_chunks x 2 array of the first snp and number of snps of each
+        chunk
+    """
+    def __init__(self, path):
+
+        # path of the file
+        self.path = path
+
+        with open(path, "rb") as fh:
+            fh.seek(len(_MAGIC))
+            offset = int(np.frombuffer(fh.read(8), dtype="<u8")[0])
+            fh.seek(offset)
+            footer = json.loads(fh.read().decode("utf-8"))
+
+        # number of individuals and snps
+        self.n, self.p = footer["n"], footer["p"]
+
+        # simulation parameters
+        self.params = footer["params"]
+
+        # index of the chunks
+        self.chunks = np.array(footer["chunks"], dtype=np.int64).reshape(-1, 2)
+
+        n_bytes = (self.n + 7) // 8
+        if self.p > 0:
+            self._packed = np.memmap(path, dtype="u1", mode="r", offset=_HEADER_SIZE,
+                                     shape=(self.p, n_bytes))
+        else:
+            self._packed = np.zeros((0, n_bytes), dtype="u1")
+
+    @staticmethod
+    def is_packed(path):
+        """Checks if a file stores packed genotypes
+
+        Arguments:
+            path : str
+                path of the file
+
+        Returns:
+            is_packed : bool
+                True if the file starts with the magic number
+        """
+        with open(path, "rb") as fh:
+            is_packed = fh.read(len(_MAGIC)) == _MAGIC
+
+        return(is_packed)
+
+    def genotypes(self, start=0, stop=None):
+        """Unpacks a range of snps
+
+        Arguments:
+            start : int
+                first snp
+            stop : int
+                snp after the last snp defaults to p
+
+        Returns:
+            y : array
+                n x (stop - start) genotype matrix
+        """
+        # drop the padding bits of the last byte of each snp
+        g = np.unpackbits(self._packed[start:stop], axis=1)[:, :self.n]
+
+        return(g.T)
+
+    def chunk(self, i):
+        """Unpacks a chunk
+
+        Arguments:
+            i : int
+                chunk id
+
+        Returns:
+            y : array
+                n x p_i genotype matrix of the chunk
+        """
+        start, p_i = self.chunks[i]
+
+        return(self.genotypes(start, start + p_i))
+
+
+class _PackedWriter(object):
+    """Writes snp blocks bit packed to a temporary file which is moved to
+    path when it is closed so an interrupted simulation leaves no file
+
+    Arguments
+    ---------
+    path : str
+        path of the file
+    n : int
+        number of individuals
+    """
+    def __init__(self, path, n):
+        self.path = path
+        self.n = n
+        self.p = 0
+        self.chunks = []
+
+        self._tmp = "{}.{}.tmp".format(path, os.getpid())
+        self._fh = open(self._tmp, "wb")
+
+        # offset of the footer is written when closing
+        self._fh.write(_MAGIC)
+        self._fh.write(np.zeros(1, dtype="<u8").tobytes())
+
+    def append(self, g):
+        """Appends a snp block
+
+        Arguments:
+            g : array
+                p_i x n genotypes
+        """
+        np.packbits(g, axis=1).tofile(self._fh)
+        self.chunks.append([self.p, int(g.shape[0])])
+        self.p += int(g.shape[0])
+
+    def close(self, params):
+        """Writes the footer and moves the file to path
+
+        Arguments:
+            params : dict
+                parameters of the simulation
+        """
+        offset = self._fh.tell()
+        footer = {"n": self.n, "p": self.p, "params": params, "chunks": self.chunks}
+        self._fh.write(json.dumps(footer).encode("utf-8"))
+        self._fh.seek(len(_MAGIC))
+        self._fh.write(np.array([offset], dtype="<u8").tobytes())
+        self._fh.close()
+        os.rename(self._tmp, self.path)
+
+    def abort(self):
+        """Removes the temporary file
+        """
+        self._fh.close()
+        os.remove(self._tmp)
+
+
+class GenotypeStore(object):
+    """Class for assembling a genotype matrix from snp blocks as they are
+    simulated. The blocks are copied into fixed size chunks of snps, in
+    memory or in a memory mapped file which is extended, so the stored
+    snps are never copied when the store grows. In memory the chunks are
+    merged into one matrix on first access which frees each chunk once it
+    is copied so the peak memory is about one genotype matrix
+
+    Arguments
+    ---------
+    n : int
+        number of individuals
+    path : str
+        if given the chunks are stored in a memory mapped file
+    chunk_size : int
+        number of snps per chunk
+
+    Attributes
+    ----------
+    n : int
+        number of individuals
+    p : int
+        number of snps
+    path : str
+        path of the memory mapped file
+    chunk_size : int
+        number of snps per chunk
+    """
+    def __init__(self, n, path=None, chunk_size=8192):
+
+        # number of individuals
+        self.n = n
+
+        # number of snps
+        self.p = 0
+
+        # path of the memory mapped file
+        self.path = path
+
+        # number of snps per chunk
+        self.chunk_size = chunk_size
+
+        # snp major chunks of which only the last one is partly filled
+        self._chunks = []
+        self._fill = 0
+
+    def _new_chunk(self):
+        """Adds an empty chunk after the last one
+        """
+        if self.path is None:
+            chunk = np.empty((self.chunk_size, self.n), dtype="u1")
+        else:
+            # extend the file and map only the new chunk
+            offset = sum(c.shape[0] for c in self._chunks) * self.n
+            with open(self.path, "ab") as fh:
+                fh.truncate(offset + self.chunk_size * self.n)
+            chunk = np.memmap(self.path, dtype="u1", mode="r+", offset=offset,
+                              shape=(self.chunk_size, self.n))
+
+        self._chunks.append(chunk)
+        self._fill = 0
+
+    def append(self, g):
+        """Appends a snp block
+
+        Arguments:
+            g : array
+                p_i x n genotypes
+        """
+        i = 0
+        while i < g.shape[0]:
+            if not self._chunks or self._fill == self._chunks[-1].shape[0]:
+                self._new_chunk()
+
+            k = min(self._chunks[-1].shape[0] - self._fill, g.shape[0] - i)
+            self._chunks[-1][self._fill:self._fill + k] = g[i:i + k]
+            self._fill += k
+            self.p += k
+            i += k
+
+    @property
+    def snps(self):
+        """p x n snps which does not see snps appended later
+        """
+        if self.path is not None:
+            # the chunks are contiguous in the file
+            for chunk in self._chunks:
+                chunk.flush()
+            if self.p == 0:
+                return(np.empty((0, self.n), dtype="u1"))
+
+            return(np.memmap(self.path, dtype="u1", mode="r", shape=(self.p, self.n)))
+
+        if len(self._chunks) > 1:
+            snps = np.empty((self.p, self.n), dtype="u1")
+            i = 0
+            while self._chunks:
+                chunk = self._chunks.pop(0)
+                k = min(chunk.shape[0], self.p - i)
+                snps[i:i + k] = chunk[:k]
+                i += k
+                del chunk
+
+            self._chunks = [snps]
+            self._fill = self.p
+
+        if self.p == 0:
+            return(np.empty((0, self.n), dtype="u1"))
+
+        return(self._chunks[0][:self._fill])
+
+    @property
+    def y(self):
+        """n x p genotype matrix which does not see snps appended later
+        """
+        return(self.snps.T)
+
+    def chunks(self):
+        """Iterates over the stored chunks without merging them
+
+        Yields:
+            y_chunk : array
+                n x p_i view of the genotype matrix
+        """
+        for i, chunk in enumerate(self._chunks):
+            k = self._fill if i == len(self._chunks) - 1 else chunk.shape[0]
+            yield(chunk[:k].T)
+
+
+def _region_genotypes(tree_sequence):
+    """Extract the genotypes of a region
+
+    Arguments:
+        tree_sequence : TreeSequence
+            geneologies and mutations of the region
+
+    Returns:
+        g : array
+            p x n snp block of the region
+    """
+    if hasattr(tree_sequence, "genotype_matrix"):
+        # sites x samples matrix in one call
+        g = tree_sequence.genotype_matrix().astype("u1")
+    else:
+        shape = tree_sequence.get_num_mutations(), tree_sequence.get_sample_size()
+        g = np.empty(shape, dtype="u1")
+
+        # loop through each tree
+        for variant in tree_sequence.variants():
+            g[variant.index] = variant.genotypes
+
+    return(g)
+
+
+def _filter_block(g, eps):
+    """Filter out rare variants of a snp block
+
+    Arguments:
+        g : array
+            p x n snp block
+        eps : float
+            min derived allele frequency
+
+    Returns:
+        g : array
+            p_kept x n snp block of the kept sites
+        sfs : array
+            n + 1 site frequency spectrum of the filtered out sites
+    """
+    n = g.shape[1]
+    count = np.sum(g, axis=1, dtype=np.int64)
+    daf = count / n
+    keep = (daf >= eps) & (daf <= (1. - eps))
+    sfs = np.bincount(count[~keep], minlength=n + 1)
+
+    return((g[keep], sfs))
+
+
+def _simulate_shard(args):
+    """Simulate a shard of replicates in a worker process
+
+    Arguments:
+        args : tuple
+            number of demes, haploids per deme, migration matrix, chrom
+            length, mutation rate, effective size, number of replicates,
+            seed of the shard and min derived allele frequency or None to
+            keep rare variants
+
+    Returns:
+        g : array
+            p x n snp block of the shard
+        sfs : array
+            n + 1 sfs of the filtered out sites or None
+    """
+    d, n_samp, m, chrom_length, mu, n_e, n_rep, seed, eps = args
+
+    population_configurations = [msprime.PopulationConfiguration(sample_size=n_samp) for _ in range(d)]
+    tree_sequences = msprime.simulate(population_configurations=population_configurations,
+                                      migration_matrix=m,
+                                      length=chrom_length,
+                                      mutation_rate=mu,
+                                      num_replicates=n_rep,
+                                      Ne=n_e,
+                                      random_seed=seed)
+
+    store = GenotypeStore(d * n_samp)
+    sfs = None if eps is None else np.zeros(d * n_samp + 1, dtype=np.int64)
+    for tree_sequence in tree_sequences:
+        g = _region_genotypes(tree_sequence)
+        if eps is not None:
+            g, sfs_i = _filter_block(g, eps)
+            sfs += sfs_i
+        store.append(g)
+
+    return((store.snps, sfs))
@@ -2,12 +2,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import warnings
+
 import networkx as nx
 import numpy as np
 
-from scipy.linalg import pinvh
-from scipy.sparse.linalg import cg
-from scipy.sparse import csr_matrix
+from scipy.linalg import eigh, pinvh
+from scipy.sparse.linalg import cg, eigsh, spilu, splu, LinearOperator
+from scipy.sparse import (coo_matrix, csc_matrix, csr_matrix, diags, identity,
+                          issparse, kron, tril, triu)
 from scipy.spatial.distance import pdist, squareform
 
 import matplotlib.pyplot as plt
@@ -23,16 +26,40 @@ class Habitat(object):
     Attributes
     ----------
     g : nx directed graph
-        directed graph object storing the Habitat
+        directed graph object storing the Habitat which is
+        built on first access
     d : int
         number of nodes in the graph
-    m : array
-        d x d matrix storing the migration
+    m : csr_matrix
+        d x d sparse matrix storing the migration
         rates
+    l : csr_matrix
+        d x d sparse graph laplacian which is computed from m on first
+        access
+    ll : csr_matrix
+        d x d sparse matrix LL' computed on first access
+    edges : array
+        E x 2 array of directed edges
+    edge_mid : array
+        E x 2 array of spatial positions of the edge midpoints
+    w : array
+        E array of edge weights
+    normalize : bool
+        whether w was normalized by set_edge_weights
+    disk_cache : DistanceCache
+        if set rw_dist, coal_dist and geo_dist results are stored on disk
+        and shared between sessions and processes
+    perm : array
+        if set fill reducing ordering of the d - 1 grounded nodes used by
+        the sparse LU factorizations instead of computing one each time
     """
     def __init__(self):
-        # graph object
-        self.g = None
+        # quantities derived from m and s which are computed on first
+        # access and cleared whenever m or s are set
+        self._cache = {}
+
+        # graph object built on first access
+        self._g = None
 
         # number of nodes in the graph
         self.d = None
@@ -43,49 +70,1208 @@ class Habitat(object):
         # d x 2 matrix of spatial positions
         self.s = None
 
+        # E x 2 matrix of directed edges
+        self.edges = None
+
+        # E x 2 matrix of spatial positions of the edge midpoints
+        self.edge_mid = None
+
+        # E vector of edge weights
+        self.w = None
+
+        # whether the edge weights were normalized
+        self.normalize = None
+
+        # iterations and residual of the last conjugate gradient solve
+        self.cg_info = None
+
+        # error bound of the last approximate random walk distance
+        self.approx_info = None
+
+        # None to detect if matrices are circulant or True or False
+        self.translation_invariant = None
+
+        # optional on disk cache of distance matrices
+        self.disk_cache = None
+
+        # fill reducing ordering of the grounded graph laplacian which is
+        # reused for migration surfaces with the same edges
+        self.perm = None
+
+    def __getstate__(self):
+        """Cached factorizations and distances are not copied or pickled,
+        e.g. when the habitat is sent to worker processes, as they are
+        recomputed on first access. The graph laplacian, which may have
+        been set directly, is kept and so is the graph unless it can be
+        rebuilt from the edge weights
+        """
+        state = self.__dict__.copy()
+        state["_cache"] = {key: value for key, value in self._cache.items() if key == "l"}
+        if self.w is not None:
+            state["_g"] = None
+
+        return(state)
+
+    @property
+    def g(self):
+        """Directed graph of the habitat which is only built from the
+        node positions and edge arrays when plotting or user code asks
+        for it
+        """
+        if self._g is None and self.edges is not None:
+            g = nx.DiGraph()
+            g.add_nodes_from((i, {"pos": tuple(s_i)}) for i, s_i in enumerate(self.s))
+            g.add_edges_from(map(tuple, self.edges))
+            if self.w is not None:
+                nx.set_edge_attributes(g, dict(zip(map(tuple, self.edges), self.w)), "m")
+            self._g = g
+
+        return(self._g)
+
+    @g.setter
+    def g(self, g):
+        self._g = g
+
+    @property
+    def m(self):
+        """Migration matrix, setting it clears all derived quantities
+        """
+        return(self._m)
+
+    @m.setter
+    def m(self, m):
+        self._m = m
+        self._cache.clear()
+
+    @property
+    def s(self):
+        """Spatial positions, setting them clears all derived quantities
+        """
+        return(self._s)
+
+    @s.setter
+    def s(self, s):
+        self._s = s
+        self._g = None
+        self._cache.clear()
+
+    @property
+    def l(self):
+        """Graph laplacian which is computed from the migration matrix on
+        first access, see get_graph_lapl
+        """
+        if "l" not in self._cache and self.m is not None:
+            self._cache["l"] = self._graph_lapl()
+
+        return(self._cache.get("l"))
+
+    @l.setter
+    def l(self, l):
+        # quantities derived from a previous graph laplacian are stale
+        self._cache.clear()
+        if l is not None:
+            self._cache["l"] = l
+
+    @property
+    def ll(self):
+        """LL' of the graph laplacian computed on first access
+        """
+        return(self._cached("ll", lambda: csr_matrix(self.l.dot(self.l.T))))
+
+    def _cached(self, key, func, persist=False, valid=None):
+        """Memoizes a quantity derived from m and s. Cached arrays are
+        shared by all callers so they are made read only and have to be
+        copied before being modified
+
+        Arguments:
+            key : hashable
+                name of the quantity and its arguments
+            func : callable
+                computes the quantity if it is not cached
+            persist : bool
+                if True and disk_cache is set the quantity is also looked
+                up in and stored to the on disk cache
+            valid : callable
+                if given it is called after func and the quantity is only
+                cached if it returns True e.g. if an iterative solve
+                converged
+
+        Returns:
+            value : object
+                cached quantity
+        """
+        if key in self._cache:
+            return(self._cache[key])
+
+        disk_key = None
+        value = None
+        if persist and self.disk_cache is not None:
+            disk_key = self.disk_cache.key(self, key)
+            value = self.disk_cache.get(disk_key)
+
+        if value is None:
+            value = func()
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+
+            if valid is not None and not valid():
+                return(value)
+
+            if disk_key is not None:
+                self.disk_cache.put(disk_key, value)
+
+        self._cache[key] = value
+
+        return(value)
+
+    @property
+    def pos_dict(self):
+        """Dictionary of spatial positions of each node
+        """
+        return(dict(enumerate(map(tuple, self.s))))
+
     def migration_surface(self):
         """User defined method to define edge weights in the graph
         as this will vary often between different simulations
         """
         raise NotImplementedError("migration_surface is not implemented")
 
+    def set_edge_weights(self, w, normalize=True):
+        """Sets the migration matrix from a vector of edge weights in one
+        vectorized step so migration surfaces can be numpy expressions over
+        the edge arrays e.g. of edge_mid. As in the barrier migration
+        surfaces the weights are divided by twice the total weight leaving
+        each deme and the matrix is symmetrized from its lower triangle
+
+        Arguments:
+            w : array
+                E array of non-negative weights for each edge in edges
+            normalize : bool
+                if False the weights are used as migration rates directly
+        """
+        self.w = np.asarray(w, dtype=np.float64)
+        self.normalize = normalize
+
+        # weighted adjacency matrix
+        z = csr_matrix((self.w, (self.edges[:, 0], self.edges[:, 1])),
+                       shape=(self.d, self.d))
+
+        if normalize:
+            z_sum = 2. * np.asarray(z.sum(axis=1)).ravel()
+            z_sum[z_sum == 0.] = 1.
+            z_norm_tril = tril(diags(1. / z_sum).dot(z))
+            self.m = (z_norm_tril + z_norm_tril.T).tocsr()
+        else:
+            self.m = z
+
+        # edge attributes of the graph are stale
+        self._g = None
+
+        self.get_graph_lapl()
+
+    def _init_edges(self, edges):
+        """Stores both directions of each undirected edge
+
+        Arguments:
+            edges : array
+                E / 2 x 2 array of undirected edges
+        """
+        # E x 2 array of directed edges
+        self.edges = np.vstack([edges, edges[:, ::-1]]).astype(np.int64)
+
+        # E x 2 array of edge midpoints
+        self.edge_mid = (self.s[self.edges[:, 0]] + self.s[self.edges[:, 1]]) / 2.
+
+    def kron_reduce(self, nodes):
+        """Reduces the habitat onto a subset of nodes e.g. the sampled
+        demes by taking the Schur complement of the graph laplacian
+        L_SS - L_SU L_UU^-1 L_US (Kron reduction) which eliminates the
+        unsampled nodes U using one sparse LU of L_UU. The reduced graph
+        laplacian is again a graph laplacian whose edges connect sampled
+        nodes through paths of unsampled nodes. Random walk distances of
+        the reduced habitat are exactly those between the sampled nodes of
+        the full habitat so they can be computed at a cost that scales with
+        the number of sampled nodes. Coalescent times are not preserved as
+        lineages also coalesce in the eliminated nodes so coal_dist of the
+        reduced habitat describes a population living only on the kept
+        nodes
+
+        Arguments:
+            nodes : array
+                k array of node ids to keep
+
+        Returns:
+            hab : Habitat
+                habitat with k nodes
+        """
+        nodes = np.asarray(nodes)
+        l = csr_matrix(self.l)
+
+        # eliminated nodes
+        u_idx = np.setdiff1d(np.arange(self.d), nodes)
+
+        l_red = l[nodes][:, nodes].toarray()
+        if u_idx.shape[0] > 0:
+            lu = splu(l[u_idx][:, u_idx].tocsc())
+            x = lu.solve(l[u_idx][:, nodes].toarray())
+            l_red = l_red - l[nodes][:, u_idx].dot(x)
+
+        hab = Habitat()
+        hab.d = nodes.shape[0]
+        hab.v = np.arange(hab.d)
+        hab.s = self.s[nodes]
+
+        # off diagonal of the reduced graph laplacian are the migration rates
+        m = -l_red
+        m[np.diag_indices(hab.d)] = 0.
+        m[np.abs(m) <= 1e-12 * np.max(np.abs(m))] = 0.
+        hab.m = csr_matrix(m)
+        hab.get_graph_lapl()
+
+        # arrays of edges
+        m = coo_matrix(hab.m)
+        hab.edges = np.column_stack([m.row, m.col]).astype(np.int64)
+        hab.edge_mid = (hab.s[hab.edges[:, 0]] + hab.s[hab.edges[:, 1]]) / 2.
+        hab.w = m.data
+
+        return(hab)
+
     def get_graph_lapl(self):
+        """Converts the migration matrix to a sparse csr matrix and
+        computes the graph laplacian. As l is computed on first access
+        this is only needed to compute it eagerly
+        """
+        # only the edges of the migration matrix are stored
+        self.m = csr_matrix(self.m)
+        self._cache["l"] = self._graph_lapl()
+
+    def _graph_lapl(self):
         """Computes the graph laplacian which is
         a d x d matrix where L = I - M as M is markov
         matrix its rows sum to 1
+
+        Returns:
+            l : csr_matrix
+                d x d sparse graph laplacian
         """
+        m = csr_matrix(self.m)
+
         # adding diagonal to migration matrix
-        m = np.zeros((self.d, self.d))
-        diag =  1. - np.sum(self.m, axis=1)
-        diag_idx = np.diag_indices(self.d)
+        diag = 1. - np.asarray(m.sum(axis=1)).ravel()
+        m = m - diags(m.diagonal()) + diags(diag)
 
-        m = np.array(self.m.tolist())
-        m[diag_idx] = diag
+        l = (identity(self.d) - m).tocsr()
 
-        self.l = np.eye(self.d) - m
+        return(l)
 
-    def rw_dist(self, q):
+    def rw_dist(self, q, nodes=None, pairs=None, approx=None, profile=False, seed=0):
         """Computes a random walk distance between nodes
         on the graph defined by the habitat. To compute the
-        random walk distance the adjaceny matrix must be symmetric
+        random walk distance the adjaceny matrix must be symmetric.
+        If q is sparse or a subset of nodes or pairs is requested, q is
+        grounded at one node and factorized once with a sparse LU and only
+        the columns of the inverse for the requested nodes are solved for.
+        This requires the null space of q to be the constant vector which
+        holds for L and for LL' when L is symmetric otherwise the dense
+        pseudo inverse is used. If q is circulant, e.g. uniform migration
+        on a circle, its pseudo inverse is computed exactly with an FFT and
+        if q is L or LL' for a habitat whose graph laplacian is a Kronecker
+        sum, e.g. separable migration on a square lattice, it is computed
+        from the eigendecompositions of the two small factors. Otherwise
+        if all distances are requested and q is L or LL' for a symmetric
+        L they are computed from the cached spectrum of L
 
         Arguments:
-            q : array
+            q : array or sparse matrix
                 d x d graph laplacian matrix L or LL'
+            nodes : array
+                k array of node ids to compute distances between
+            pairs : array
+                n x 2 array of pairs of node ids to compute distances
+                between
+            approx : float
+                if given the distances are approximated within a factor of
+                1 +/- approx from a random projection embedding, see
+                _rw_embedding, and the bound is stored in approx_info
+            profile : bool
+                if True only the distances from the first node are computed
+            seed : int
+                seed of the random projections of approx
 
         Returns:
             r : array
                 d x d array of random walk distances between
-                each node
+                each node or k x k if nodes is given or n if pairs
+                is given or d if profile is True. All distances of L or
+                LL' are memoized and read only, see _cached
         """
-        # invert the graph lapl ... pinvh assumes q is symmetric and psd
-        q_inv = pinvh(q)
+        if not self._is_symmetric(q):
+            warnings.warn("q is not symmetric so random walk distances are not defined, "
+                          "use commute_dist for directed habitats")
+
+        if approx is None and nodes is None and pairs is None and not profile:
+            # all distances for L or LL' are memoized
+            p = self._lapl_power(q)
+            if p is not None:
+                r = self._cached(("rw_dist", p), lambda: self._rw_dist(q), persist=True)
+
+                return(r)
+
+        r = self._rw_dist(q, nodes=nodes, pairs=pairs, approx=approx, profile=profile,
+                          seed=seed)
+
+        return(r)
+
+    def _rw_dist(self, q, nodes=None, pairs=None, approx=None, profile=False, seed=0):
+        """Computes random walk distances, see rw_dist
+        """
+        if profile:
+            pairs = np.column_stack([np.zeros(self.d, dtype=np.int64), np.arange(self.d)])
+
+        # first row of q if it is circulant
+        q_row = self._circulant_row(q) if approx is None else None
+
+        if q_row is not None:
+
+            # the pseudo inverse of a circulant matrix is circulant and
+            # diagonalized by the discrete fourier transform
+            q_inv_col = self._circulant_pinv(np.roll(q_row[::-1], 1))
+
+            # distances only depend on the offset between nodes
+            r_row = 2. * q_inv_col[0] - q_inv_col - np.roll(q_inv_col[::-1], 1)
+
+            if pairs is not None:
+                pairs = np.asarray(pairs)
+                r = r_row[(pairs[:, 1] - pairs[:, 0]) % self.d]
+            else:
+                sel = np.arange(self.d) if nodes is None else np.asarray(nodes)
+                r = r_row[(sel[None, :] - sel[:, None]) % self.d]
+
+            return(r)
+
+        # eigendecomposition of the factors if q is a Kronecker sum
+        kron_eig = self._kron_eig(q) if approx is None else None
+
+        if kron_eig is not None:
+            q_inv_diag = self._kron_pinv_diag(kron_eig)
+
+            if pairs is not None:
+                # columns of the pseudo inverse for the first node of each pair
+                pairs = np.asarray(pairs)
+                first, first_idx = np.unique(pairs[:, 0], return_inverse=True)
+                q_inv_cols = self._kron_pinv_cols(kron_eig, first)
+                r = (q_inv_diag[pairs[:, 0]] + q_inv_diag[pairs[:, 1]] -
+                     2. * q_inv_cols[pairs[:, 1], first_idx])
+            else:
+                sel = np.arange(self.d) if nodes is None else np.asarray(nodes)
+                r = self._cov_to_dist(self._kron_pinv_cols(kron_eig, sel)[sel])
+
+            return(r)
+
+        # the pseudo inverse G of a symmetric L is computed from its cached
+        # spectrum when all distances are requested and is kept up to date
+        # by update_edges. The pseudo inverse of LL' is then GG
+        p = self._lapl_power(q) if approx is None else None
+        if (p is not None and nodes is None and pairs is None and
+                self._is_symmetric(self.l)):
+            self._cached("pinv", self._lapl_pinv)
+
+        if pairs is not None:
+            r = self._rw_pair_dist(q, np.asarray(pairs), p, approx, seed)
+
+            return(r)
+
+        # nodes to solve for
+        sel = np.arange(self.d) if nodes is None else np.asarray(nodes)
+
+        if approx is not None:
+
+            # inner products of the embedded nodes summed over the batches
+            # of projections
+            x = np.zeros((sel.shape[0], sel.shape[0]))
+            for z in self._rw_embedding(q, approx, seed):
+                x += z[:, sel].T.dot(z[:, sel])
+
+        elif p is not None and "pinv" in self._cache:
+            g_inv = self._cache["pinv"]
+            x = g_inv[np.ix_(sel, sel)] if p == 1 else g_inv[sel].dot(g_inv[:, sel])
+
+        elif ((issparse(q) or nodes is not None or pairs is not None) and
+              self._const_kernel(q)):
+
+            # the grounded inverse gives the same distances as the pseudo
+            # inverse as distances are invariant to adding constants
+            lu = self._grounded_lu(q)
+            x = np.empty((sel.shape[0], sel.shape[0]))
+            for batch in self._batches(sel.shape[0]):
+                x[:, batch] = self._grounded_solve(lu, self._unit_cols(sel[batch]))[sel]
+
+        else:
+
+            # invert the graph lapl ... pinvh assumes q is symmetric and psd
+            q = q.toarray() if issparse(q) else q
+            x = pinvh(q)[np.ix_(sel, sel)]
 
         # compute the random walk dist
-        r = self._cov_to_dist(q_inv)
+        r = self._cov_to_dist(x)
 
         return(r)
 
+    def _rw_pair_dist(self, q, pairs, p, approx, seed):
+        """Computes random walk distances between pairs of nodes as
+        (e_i - e_j)' X (e_i - e_j) for any generalized inverse X of q
+        without forming the block of X for all nodes of the pairs. With
+        a grounded sparse LU the differences of unit columns are solved in
+        batches
+
+        Arguments:
+            q : array or sparse matrix
+                d x d graph laplacian matrix L or LL'
+            pairs : array
+                n x 2 array of pairs of node ids
+            p : int
+                power of L if q is L or LL' otherwise None
+            approx : float
+                see rw_dist
+            seed : int
+                see rw_dist
+
+        Returns:
+            r : array
+                n array of random walk distances
+        """
+        i, j = pairs[:, 0], pairs[:, 1]
+
+        if approx is not None:
+            # squared distances of the embedded nodes summed over the
+            # batches of projections
+            r = np.zeros(pairs.shape[0])
+            for z in self._rw_embedding(q, approx, seed):
+                r += np.sum((z[:, i] - z[:, j]) ** 2, axis=0)
+
+        elif p is not None and "pinv" in self._cache:
+            g_inv = self._cache["pinv"]
+            if p == 1:
+                r = g_inv[i, i] + g_inv[j, j] - 2. * g_inv[i, j]
+            else:
+                # the pseudo inverse of LL' is GG with G symmetric
+                r = np.empty(pairs.shape[0])
+                for batch in self._batches(pairs.shape[0]):
+                    r[batch] = np.sum((g_inv[i[batch]] - g_inv[j[batch]]) ** 2, axis=1)
+
+        elif self._const_kernel(q):
+            lu = self._grounded_lu(q)
+            r = np.empty(pairs.shape[0])
+            for batch in self._batches(pairs.shape[0]):
+                k = np.arange(batch.stop - batch.start)
+                b = np.zeros((self.d, k.shape[0]))
+                b[i[batch], k] += 1.
+                b[j[batch], k] -= 1.
+                x = self._grounded_solve(lu, b)
+                r[batch] = x[i[batch], k] - x[j[batch], k]
+
+        else:
+            q = q.toarray() if issparse(q) else q
+            x = pinvh(q)
+            r = x[i, i] + x[j, j] - 2. * x[i, j]
+
+        return(r)
+
+    def _batches(self, n):
+        """Slices of batches of columns so a d x batch dense right hand
+        side has at most 2^22 entries
+
+        Arguments:
+            n : int
+                number of columns
+
+        Returns:
+            batches : list
+                slices of the batches
+        """
+        size = max(1, min(256, 2 ** 22 // self.d))
+        batches = [slice(k, min(k + size, n)) for k in range(0, n, size)]
+
+        return(batches)
+
+    def _lapl_pinv(self):
+        """Pseudo inverse of a symmetric graph laplacian from its spectrum
+
+        Returns:
+            g_inv : array
+                d x d pseudo inverse of L
+        """
+        lam, u = self.spectrum()
+
+        # exclude the null mode
+        f = np.zeros(self.d)
+        nz_idx = lam > 1e-10 * abs(self.l).max()
+        f[nz_idx] = 1. / lam[nz_idx]
+
+        g_inv = (u * f).dot(u.T)
+
+        return(g_inv)
+
+    def update_edges(self, idx, new_w, normalize=None, max_rank=None):
+        """Changes the weights of a few edges and updates the cached pseudo
+        inverse of a symmetric graph laplacian with a low rank Woodbury
+        correction instead of recomputing it, see pinv_update. Only the k
+        nodes incident to the changed entries of L enter the correction
+        which costs O(d^2 k) instead of O(d^3). Once the rank of the
+        corrections since the last full computation exceeds max_rank the
+        pseudo inverse is dropped and recomputed on the next call to
+        rw_dist. The last coal_dist solution is kept as the initial guess
+        for the next sparse or matrix_free solve
+
+        Arguments:
+            idx : array
+                indices of the changed edges in edges
+            new_w : array
+                new weights of the changed edges
+            normalize : bool
+                see set_edge_weights defaults to how the current weights
+                were set
+            max_rank : int
+                maximum accumulated rank of the corrections defaults to d / 4
+        """
+        if normalize is None:
+            normalize = True if self.normalize is None else self.normalize
+        if max_rank is None:
+            max_rank = self.d // 4
+
+        g_inv = self._cache.get("pinv")
+        rank = self._cache.get("pinv_rank", 0)
+        l_old = self.l
+
+        # last full coalescent time matrix
+        t = None
+        for key, value in self._cache.items():
+            if isinstance(key, tuple) and key[0] == "coal_dist" and not key[-1]:
+                t = value
+
+        w = np.array(self.w, dtype=np.float64)
+        w[idx] = new_w
+        self.set_edge_weights(w, normalize=normalize)
+
+        if t is not None:
+            self._cache["coal_x0"] = t
+
+        if g_inv is None or not self._is_symmetric(self.l):
+            return
+
+        # nodes incident to the change of the graph laplacian
+        delta = coo_matrix(self.l - l_old)
+        nz_idx = delta.data != 0.
+        nodes = np.unique(np.concatenate([delta.row[nz_idx], delta.col[nz_idx]]))
+
+        rank += nodes.shape[0]
+        if rank > max_rank:
+            return
+
+        delta = csr_matrix(delta)[nodes][:, nodes].toarray()
+        try:
+            g_inv = pinv_update(g_inv, nodes, delta)
+        except np.linalg.LinAlgError:
+            # the change disconnected the habitat
+            return
+
+        self._cache["pinv"] = g_inv
+        self._cache["pinv_rank"] = rank
+
+    def stationary_dist(self):
+        """Computes the stationary distribution of the random walk on the
+        habitat which solves pi' L = 0 from the grounded sparse LU of L
+
+        Returns:
+            pi : array
+                d array of stationary probabilities
+        """
+        def solve():
+            l = csr_matrix(self.l)
+            lu = self._grounded_lu(l)
+
+            # fixing pi of the grounded node at 1
+            pi = np.ones(self.d)
+            pi[:-1] = lu.solve(-l[-1, :-1].toarray().ravel(), trans="T")
+
+            return(pi / np.sum(pi))
+
+        pi = self._cached("stationary_dist", solve)
+
+        return(pi)
+
+    def commute_dist(self, nodes=None, kind="commute"):
+        """Computes mean first passage (hitting) times or commute times of
+        the random walk on the habitat which are defined for asymmetric
+        migration. With the grounded inverse X of L from one sparse LU and
+        the stationary distribution pi the hitting time from i to j is
+        H_ij = (X1)_i - (X1)_j + (X_jj - X_ij) / pi_j and the commute time
+        is H_ij + H_ji. Only the columns of X for the requested nodes are
+        solved for so L is never densified. For symmetric migration the
+        commute time is d times the resistance distance
+
+        Arguments:
+            nodes : array
+                k array of node ids to compute times between
+            kind : str
+                "commute" or "hitting"
+
+        Returns:
+            r : array
+                d x d or k x k array of times where the hitting time from
+                node i to node j is r[i, j]
+        """
+        sel = np.arange(self.d) if nodes is None else np.asarray(nodes)
+
+        l = csr_matrix(self.l)
+        lu = self._grounded_lu(l)
+        pi = self.stationary_dist()
+
+        x = self._grounded_solve(lu, self._unit_cols(sel))
+        y = self._grounded_solve(lu, np.ones(self.d))
+
+        x_sel = x[sel]
+        h = (y[sel][:, None] - y[sel][None, :] +
+             (np.diag(x_sel)[None, :] - x_sel) / pi[sel][None, :])
+
+        if kind == "hitting":
+            r = h
+        elif kind == "commute":
+            r = h + h.T
+        else:
+            raise ValueError("kind must be commute or hitting")
+
+        return(r)
+
+    def spectrum(self, k=None):
+        """Computes and caches the eigendecomposition of a symmetric graph
+        laplacian so that many functions of it can be evaluated without
+        solving the eigenproblem again. The cache is reset when the graph
+        laplacian is recomputed
+
+        Arguments:
+            k : int
+                if given only the k smallest eigenpairs are computed with
+                shift invert Lanczos which suffices for large habitats when
+                f decays with the eigenvalue
+
+        Returns:
+            lam : array
+                d or k eigenvalues in increasing order
+            u : array
+                d x d or d x k eigenvectors
+        """
+        if ("spectrum", k) not in self._cache:
+            if not self._is_symmetric(self.l):
+                raise ValueError("spectrum requires a symmetric graph laplacian")
+
+            if k is None:
+                l = self.l.toarray() if issparse(self.l) else np.asarray(self.l)
+                lam, u = eigh(l)
+            else:
+                # shift slightly below zero as L is singular
+                sigma = -1e-6 * abs(self.l).max()
+                lam, u = eigsh(csc_matrix(self.l), k=k, sigma=sigma, which="LM")
+                idx = np.argsort(lam)
+                lam, u = lam[idx], u[:, idx]
+
+            self._cache[("spectrum", k)] = (lam, u)
+
+        return(self._cache[("spectrum", k)])
+
+    def matrix_function_dist(self, f, nodes=None, k=None, t=1.):
+        """Computes a distance between nodes defined by a function of the
+        graph laplacian using its cached spectrum
+        D_ij = sum_n f(lam_n) (u_ni - u_nj)^2 where the null mode is excluded
+
+        Arguments:
+            f : str or callable
+                "resistance" f = 1 / lam, "rw" the random walk distance of
+                LL' f = 1 / lam^2, "commute" the commute time of the random
+                walk f = d / lam, "diffusion" the diffusion distance at time
+                t f = exp(-2 t lam) or a function applied to the eigenvalues
+            nodes : array
+                k array of node ids to compute distances between
+            k : int
+                number of smallest eigenpairs to use see spectrum
+            t : float
+                time of the diffusion distance
+
+        Returns:
+            r : array
+                d x d or k x k array of distances
+        """
+        if not callable(f) and nodes is None:
+            r = self._cached(("matrix_function_dist", f, k, t),
+                             lambda: self.matrix_function_dist(f, nodes=np.arange(self.d), k=k, t=t))
+
+            return(r)
+
+        funcs = {"resistance": lambda lam: 1. / lam,
+                 "rw": lambda lam: 1. / lam ** 2,
+                 "commute": lambda lam: self.d / lam,
+                 "diffusion": lambda lam: np.exp(-2. * t * lam)}
+        if not callable(f):
+            f = funcs[f]
+
+        lam, u = self.spectrum(k)
+        if nodes is not None:
+            u = u[np.asarray(nodes)]
+
+        # exclude the null mode
+        nz_idx = lam > 1e-10 * abs(self.l).max()
+        f_lam = f(lam[nz_idx])
+
+        x = (u[:, nz_idx] * f_lam).dot(u[:, nz_idx].T)
+        r = self._cov_to_dist(x)
+
+        return(r)
+
+    def _is_symmetric(self, q):
+        """Checks if q is symmetric
+
+        Arguments:
+            q : array or sparse matrix
+                d x d matrix
+
+        Returns:
+            is_sym : bool
+                True if q = q'
+        """
+        is_sym = abs(q - q.T).max() <= 1e-12 * max(abs(q).max(), 1.)
+
+        return(is_sym)
+
+    def _rw_embedding(self, q, eps, seed=0):
+        """Random projection embedding of the nodes in which squared
+        euclidean distances approximate random walk distances (Spielman and
+        Srivastava 2011). Writing q = F'F, the distance between i and j is
+        ||F q^+ (e_i - e_j)||^2 so projecting the rows of F onto
+        k = 24 log(d) / eps^2 random +/- 1 / sqrt(k) directions preserves all
+        distances within a factor of 1 +/- eps with probability at least
+        1 - 1 / d. Each direction costs one solve with a grounded sparse LU.
+        F is the weighted incidence matrix when q is a graph laplacian and L'
+        when q is LL'. The directions are drawn and solved for in batches so
+        neither the projection nor the embedding is ever formed
+
+        Arguments:
+            q : array or sparse matrix
+                d x d graph laplacian matrix L or LL'
+            eps : float
+                relative error of the approximation
+            seed : int
+                seed of the random state drawing the directions
+
+        Yields:
+            z : array
+                batch x d rows of the embedding of the nodes
+        """
+        q = csr_matrix(q)
+
+        # number of random projections
+        k = int(np.ceil(24. * np.log(self.d) / eps ** 2))
+
+        q_triu = triu(q, 1).tocoo()
+        if np.all(q_triu.data <= 0.):
+
+            # weighted incidence matrix of the edges of the graph laplacian
+            n_e = q_triu.nnz
+            w_sqrt = np.sqrt(-q_triu.data)
+            f = csr_matrix((np.concatenate([w_sqrt, -w_sqrt]),
+                            (np.tile(np.arange(n_e), 2),
+                             np.concatenate([q_triu.row, q_triu.col]))),
+                           shape=(n_e, self.d))
+
+        elif self._lapl_power(q) == 2:
+            f = csr_matrix(self.l).T.tocsr()
+
+        else:
+            raise ValueError("approx requires q to be a graph laplacian L or LL'")
+
+        if not self._const_kernel(q):
+            raise ValueError("approx requires the null space of q to be constant")
+
+        self.approx_info = {"eps": eps, "k": k, "prob": 1. - 1. / self.d}
+
+        rng = np.random.RandomState(seed)
+        lu = self._grounded_lu(q)
+        for batch in self._batches(k):
+
+            # random projection of the rows of F
+            n_b = batch.stop - batch.start
+            p = (2. * rng.randint(0, 2, size=(f.shape[0], n_b), dtype=np.int8) - 1.) / np.sqrt(k)
+            y = f.T.dot(p)
+
+            yield(self._grounded_solve(lu, y).T)
+
+    def _const_kernel(self, q):
+        """Checks if the constant vector is in the null space of q and
+        of its transpose
+
+        Arguments:
+            q : array or sparse matrix
+                d x d matrix
+
+        Returns:
+            is_const : bool
+                True if q1 = 0 and q'1 = 0
+        """
+        ones = np.ones(self.d)
+        tol = 1e-10 * max(abs(q).max(), 1.)
+        is_const = (np.all(np.abs(q.dot(ones)) <= tol) and
+                    np.all(np.abs(q.T.dot(ones)) <= tol))
+
+        return(is_const)
+
+    def _lapl_power(self, q):
+        """Checks if q is the graph laplacian L of the habitat or LL'
+
+        Arguments:
+            q : array or sparse matrix
+                d x d matrix
+
+        Returns:
+            p : int
+                1 if q is L, 2 if q is LL' and None otherwise
+        """
+        l = csr_matrix(self.l)
+        q = csr_matrix(q)
+        tol = 1e-12 * max(abs(l).max(), 1.)
+
+        p = None
+        if abs(q - l).max() <= tol:
+            p = 1
+        elif abs(q - self.ll).max() <= tol:
+            p = 2
+
+        return(p)
+
+    def _circulant_row(self, q):
+        """Checks if q is circulant i.e. invariant to translations of the
+        nodes around a circle. The check is skipped if translation_invariant
+        is set to True or False
+
+        Arguments:
+            q : array or sparse matrix
+                d x d matrix
+
+        Returns:
+            q_row : array
+                d first row of q or None if q is not circulant
+        """
+        if self.translation_invariant is False:
+            return(None)
+
+        q = coo_matrix(csr_matrix(q))
+        q.eliminate_zeros()
+
+        # first row of q
+        q_row = np.zeros(self.d)
+        q_row[q.col[q.row == 0]] = q.data[q.row == 0]
+
+        if self.translation_invariant is None:
+            # every row must be a shift of the first row
+            is_circ = (q.nnz == self.d * np.count_nonzero(q_row) and
+                       np.allclose(q.data, q_row[(q.col - q.row) % self.d]))
+            if not is_circ:
+                return(None)
+
+        return(q_row)
+
+    def _circulant_pinv(self, q_col):
+        """Pseudo inverse of a circulant matrix in O(d log d) with the FFT
+        as its eigenvalues are the discrete fourier transform of its first
+        column
+
+        Arguments:
+            q_col : array
+                d first column of a circulant matrix
+
+        Returns:
+            q_inv_col : array
+                d first column of the pseudo inverse
+        """
+        lam = np.fft.fft(q_col)
+        lam_inv = np.zeros(self.d, dtype=np.complex128)
+        nz_idx = np.abs(lam) > 1e-10 * np.max(np.abs(lam))
+        lam_inv[nz_idx] = 1. / lam[nz_idx]
+        q_inv_col = np.real(np.fft.ifft(lam_inv))
+
+        return(q_inv_col)
+
+    def pinv_diag(self, q, nodes=None):
+        """Computes selected diagonal elements of the pseudo inverse of
+        q from a grounded sparse LU without forming the inverse. With the
+        grounded inverse X and y = X1 the pseudo inverse is
+        (I - J/d) X (I - J/d) so its diagonal is X_ii - 2 y_i / d + sum(y) / d^2
+
+        Arguments:
+            q : array or sparse matrix
+                d x d graph laplacian matrix L or LL'
+            nodes : array
+                k array of node ids
+
+        Returns:
+            q_inv_diag : array
+                d or k array of diagonal elements of the pseudo inverse
+        """
+        if nodes is None:
+            nodes = np.arange(self.d)
+
+        # eigendecomposition of the factors if q is a Kronecker sum
+        kron_eig = self._kron_eig(q)
+        if kron_eig is not None:
+            q_inv_diag = self._kron_pinv_diag(kron_eig)[nodes]
+
+            return(q_inv_diag)
+
+        if not self._const_kernel(q):
+            q = q.toarray() if issparse(q) else q
+            q_inv_diag = np.diag(pinvh(q))[nodes]
+
+            return(q_inv_diag)
+
+        lu = self._grounded_lu(q)
+        y = self._grounded_solve(lu, np.ones(self.d))
+
+        # solve for the columns in batches so the inverse is never formed
+        nodes = np.asarray(nodes)
+        x_diag = np.empty(len(nodes))
+        for batch in self._batches(len(nodes)):
+            x = self._grounded_solve(lu, self._unit_cols(nodes[batch]))
+            x_diag[batch] = x[nodes[batch], np.arange(batch.stop - batch.start)]
+
+        q_inv_diag = x_diag - 2. * y[nodes] / self.d + np.sum(y) / self.d ** 2
+
+        return(q_inv_diag)
+
+    def pinv_cols(self, q, nodes):
+        """Computes selected columns of the pseudo inverse of q from a
+        grounded sparse LU without forming the inverse. With the grounded
+        inverse X and y = X1 the column of node j is x_j - y / d projected
+        onto the complement of the null space
+
+        Arguments:
+            q : array or sparse matrix
+                d x d graph laplacian matrix L or LL'
+            nodes : array
+                k array of node ids
+
+        Returns:
+            q_inv_cols : array
+                d x k columns of the pseudo inverse
+        """
+        nodes = np.asarray(nodes)
+
+        # eigendecomposition of the factors if q is a Kronecker sum
+        kron_eig = self._kron_eig(q)
+        if kron_eig is not None:
+            q_inv_cols = self._kron_pinv_cols(kron_eig, nodes)
+
+            return(q_inv_cols)
+
+        if not self._const_kernel(q):
+            q = q.toarray() if issparse(q) else q
+            q_inv_cols = pinvh(q)[:, nodes]
+
+            return(q_inv_cols)
+
+        lu = self._grounded_lu(q)
+        x = self._grounded_solve(lu, self._unit_cols(nodes))
+        y = self._grounded_solve(lu, np.ones(self.d))
+
+        q_inv_cols = x - y[:, None] / self.d
+        q_inv_cols = q_inv_cols - np.mean(q_inv_cols, axis=0, keepdims=True)
+
+        return(q_inv_cols)
+
+    def _kron_factors(self):
+        """Factors A and B of the graph laplacian if it is a Kronecker sum
+        L = A x I + I x B which habitats with a product structure can
+        detect
+
+        Returns:
+            factors : tuple
+                A and B or None if the graph laplacian is not a Kronecker sum
+        """
+        return(None)
+
+    def _kron_eig(self, q):
+        """Eigendecompositions of symmetric Kronecker sum factors of the
+        graph laplacian if q is L or LL'. The eigenvectors of L are then
+        u_i x v_j with eigenvalues a_i + b_j and q has eigenvalues
+        (a_i + b_j)^p
+
+        Arguments:
+            q : array or sparse matrix
+                d x d graph laplacian matrix L or LL'
+
+        Returns:
+            kron_eig : tuple
+                eigenvectors u and v of the factors and r x c array of the
+                eigenvalues of the pseudo inverse of q or None
+        """
+        factors = self._cached("kron_factors", self._kron_factors)
+        if factors is None:
+            return(None)
+
+        a, b = factors
+        if not (np.allclose(a, a.T) and np.allclose(b, b.T)):
+            return(None)
+
+        p = self._lapl_power(q)
+        if p is None:
+            return(None)
+
+        kron_eig = self._cached(("kron_eig", p), lambda: self._kron_pinv_eig(a, b, p))
+
+        return(kron_eig)
+
+    def _kron_pinv_eig(self, a, b, p):
+        """Eigendecompositions of the Kronecker sum factors and the
+        eigenvalues of the pseudo inverse of (A x I + I x B)^p
+
+        Arguments:
+            a : array
+                r x r symmetric factor
+            b : array
+                c x c symmetric factor
+            p : int
+                1 for L and 2 for LL'
+
+        Returns:
+            kron_eig : tuple
+                see _kron_eig
+        """
+        lam_a, u = eigh(a)
+        lam_b, v = eigh(b)
+        lam = (lam_a[:, None] + lam_b[None, :]) ** p
+
+        # pseudo inverse excludes the null mode
+        f = np.zeros(lam.shape)
+        nz_idx = lam > 1e-10 * np.max(lam)
+        f[nz_idx] = 1. / lam[nz_idx]
+
+        return((u, v, f))
+
+    def _kron_pinv_cols(self, kron_eig, nodes):
+        """Columns of the pseudo inverse of a Kronecker sum. With node k
+        at i, j the column is U (F * outer(u_i, v_j)) V' reshaped to a
+        vector which costs O(d (r + c)) per node
+
+        Arguments:
+            kron_eig : tuple
+                output of _kron_eig
+            nodes : array
+                k array of node ids
+
+        Returns:
+            q_inv_cols : array
+                d x k columns of the pseudo inverse
+        """
+        u, v, f = kron_eig
+        i, j = np.divmod(np.asarray(nodes), v.shape[0])
+        q_inv_cols = np.matmul(u, np.matmul(f * (u[i][:, :, None] * v[j][:, None, :]), v.T))
+
+        return(q_inv_cols.reshape(len(i), self.d).T)
+
+    def _kron_pinv_diag(self, kron_eig):
+        """Diagonal of the pseudo inverse of a Kronecker sum which is
+        (U * U) F (V * V)' reshaped to a vector
+
+        Arguments:
+            kron_eig : tuple
+                output of _kron_eig
+
+        Returns:
+            q_inv_diag : array
+                d diagonal of the pseudo inverse
+        """
+        u, v, f = kron_eig
+        q_inv_diag = (u ** 2).dot(f).dot((v ** 2).T)
+
+        return(q_inv_diag.ravel())
+
+    def _grounded_lu(self, q):
+        """Sparse LU of q with the row and column of the last node
+        removed which is non-singular for a connected habitat
+
+        Arguments:
+            q : array or sparse matrix
+                d x d graph laplacian matrix L or LL'
+
+        Returns:
+            lu : SuperLU
+                factorization of the grounded q
+        """
+        p = self._lapl_power(q)
+        if p is not None:
+            # the factorization of L or LL' is memoized
+            lu = self._cached(("grounded_lu", p), lambda: self._splu(csc_matrix(q)[:-1, :-1]))
+        else:
+            lu = self._splu(csc_matrix(q)[:-1, :-1])
+
+        return(lu)
+
+    def _splu(self, q):
+        """Sparse LU of a grounded matrix. If perm is set the matrix is
+        permuted with this fill reducing ordering, e.g. found for another
+        migration surface with the same edges, and factorized without
+        computing an ordering or pivoting
+
+        Arguments:
+            q : sparse matrix
+                d - 1 x d - 1 grounded matrix
+
+        Returns:
+            lu : SuperLU or _PermutedLU
+                factorization of q
+        """
+        if self.perm is None:
+            lu = splu(q.tocsc())
+        else:
+            q = csr_matrix(q)[self.perm][:, self.perm]
+            lu = _PermutedLU(splu(q.tocsc(), permc_spec="NATURAL", diag_pivot_thresh=0.,
+                                 options={"SymmetricMode": True}), self.perm)
+
+        return(lu)
+
+    def _unit_cols(self, nodes):
+        """Columns of the identity for a set of nodes
+
+        Arguments:
+            nodes : array
+                k array of node ids
+
+        Returns:
+            e : array
+                d x k unit columns
+        """
+        nodes = np.asarray(nodes)
+        e = np.zeros((self.d, nodes.shape[0]))
+        e[nodes, np.arange(nodes.shape[0])] = 1.
+
+        return(e)
+
+    def _grounded_solve(self, lu, b):
+        """Solves the grounded system keeping the potential of the
+        grounded node at zero
+
+        Arguments:
+            lu : SuperLU
+                factorization of the grounded q
+            b : array
+                d or d x k right hand side
+
+        Returns:
+            x : array
+                d or d x k solution with zeros in the grounded row
+        """
+        x = np.zeros(b.shape)
+        x[:-1] = lu.solve(np.asarray(b[:-1], dtype=np.float64))
+
+        return(x)
+
     def geo_dist(self):
         """Computes geographic distance between nodes
         on the graph defined by the habitat.
@@ -99,78 +1285,449 @@ class Habitat(object):
                 d x d of geographic distances between each
                 node
         """
-        r = squareform(pdist(self.s, metric="seuclidean")) / 2
+        r = self._cached("geo_dist", lambda: squareform(pdist(self.s, metric="seuclidean")) / 2,
+                         persist=True)
 
         return(r)
 
-    def coal_dist(self, tol=1e-8):
+    def coal_dist(self, tol=1e-8, method=None, precond=None, x0=None, profile=False):
         """Computes expected genetic distance between nodes
         on the graph defined by the habitat under a coalescent
         stepping stone model for migration with constant population
-        sizes
+        sizes. The number of iterations and relative residual of the
+        last conjugate gradient solve are stored in cg_info
 
         Arguments:
             tol : float
                 tolerence for solving linear system using conjugate gradient
+            method : str
+                "sparse" solves the d(d+1)/2 pair equations assembled as a
+                sparse matrix and "matrix_free" applies the operator
+                L T + T L' + diag(T) to a d x d array of coalescent times
+                without ever forming the matrix and "sylvester" uses one
+                eigendecomposition of a symmetric graph laplacian to solve
+                the Kronecker sum L + L exactly, iterating only on the d
+                within deme coalescent times and "fft" solves the equations
+                exactly in O(d log d) when L is circulant. If None fft is
+                used when L is circulant and sparse otherwise
+            precond : str
+                preconditioner for the sparse and matrix_free methods one of
+                None, "jacobi", "ilu" or "amg" where "amg" adds a coarse
+                correction over aggregates of neighboring demes to jacobi.
+                ilu and amg require the sparse method
+            x0 : array
+                d x d initial guess for the sparse and matrix_free methods
+                e.g. the solution for a nearby migration surface which
+                defaults to the solution before the last update_edges
+            profile : bool
+                if True only the distances from the first node are returned
         Returns:
             t : array
                 d x d of expected genetic distances between each
-                node
+                node or d if profile is True. Without x0 the result is
+                memoized and read only, see _cached
         """
-        # upper tri indicies including diagonal
-        triu_idx = np.triu_indices(self.d, 0)
+        if x0 is None:
+            # solutions without a warm start are memoized
+            # solutions of a solve that did not converge are not memoized
+            t = self._cached(("coal_dist", tol, method, precond, profile),
+                             lambda: self._coal_dist(tol, method, precond, profile=profile),
+                             persist=True,
+                             valid=lambda: self.cg_info is None or self.cg_info["converged"])
+        else:
+            t = self._coal_dist(tol, method, precond, x0=x0, profile=profile)
 
-        # number of within deme equations and between deme equations
-        n_wb = triu_idx[0].shape[0]
+        return(t)
 
-        # d x d matrix storing indicies of each pair
-        h = np.zeros((self.d, self.d), dtype=np.int64)
-        k = 0
+    def _coal_dist(self, tol, method, precond, x0=None, profile=False):
+        """Solves for the expected genetic distances, see coal_dist
+        """
+        # set again by the conjugate gradient solves
+        self.cg_info = None
+
+        if x0 is None:
+            # solution before the last update_edges
+            x0 = self._cache.get("coal_x0")
+        if method is None:
+            method = "fft" if self._circulant_row(self.l) is not None else "sparse"
+
+        if method == "fft":
+            t_row = self._coal_fft()
+            if profile:
+                return(t_row)
+
+            # translation invariance
+            v = np.arange(self.d)
+            t = t_row[(v[None, :] - v[:, None]) % self.d]
+
+        elif method == "sparse":
+
+            # upper tri indicies including diagonal
+            triu_idx = np.triu_indices(self.d, 0)
+
+            # sparse coefficents of coal time equation
+            A = self._coal_matrix()
+
+            # solution to coal time equation where the within deme
+            # equations are halved to keep the system symmetric
+            b = np.ones(A.shape[0])
+            b[triu_idx[0] == triu_idx[1]] = .5
+
+            if x0 is not None:
+                x0 = x0[triu_idx]
+
+            M = self._coal_precond(A, precond)
+
+            t_ = self._cg(A, b, tol, M=M, x0=x0)
+            t = np.zeros((self.d, self.d))
+            t[triu_idx] = t_
+            t = t + t.T - np.diag(np.diag(t))
+
+        elif method == "matrix_free":
+
+            # implicit coefficents of coal time equation
+            A = self._coal_operator()
+
+            # solution to coal time equation
+            b = np.ones(self.d ** 2)
+
+            if x0 is not None:
+                x0 = np.ravel(x0)
+
+            if precond is None:
+                M = None
+            elif precond == "jacobi":
+                M = self._coal_jacobi()
+            else:
+                raise ValueError("matrix_free method only supports jacobi preconditioning")
+
+            t_ = self._cg(A, b, tol, M=M, x0=x0)
+            t = t_.reshape(self.d, self.d)
+
+            # remove round off asymmetry
+            t = (t + t.T) / 2.
+
+        elif method == "sylvester":
+            t = self._coal_sylvester(tol)
+
+        else:
+            raise ValueError("method must be sparse, matrix_free, sylvester or fft")
+
+        if profile:
+            t = t[0]
+
+        return(t)
+
+    def _coal_fft(self):
+        """Solves the coalescent time equations when the graph laplacian is
+        circulant. Then T[i, j] = t[j - i] and with c the first row of L the
+        equations are 2 Re(fft(c)) fft(t) + t[0] = d 1{n = 0} in the fourier
+        domain. As fft(c)[0] = 0 this gives t[0] = d and fft(t) for n > 0
+        while fft(t)[0] follows from t[0] = mean(fft(t))
+
+        Returns:
+            t : array
+                d expected coalescent times between the first node and
+                every other node
+        """
+        l_row = self._circulant_row(self.l)
+        if l_row is None:
+            raise ValueError("fft method requires a circulant graph laplacian")
+
+        lam = 2. * np.real(np.fft.fft(l_row))
+
+        t_hat = np.zeros(self.d)
+        t_hat[1:] = -self.d / lam[1:]
+        t_hat[0] = self.d ** 2 - np.sum(t_hat[1:])
+        t = np.real(np.fft.ifft(t_hat))
+
+        return(t)
+
+    def _cg(self, A, b, tol, M=None, x0=None):
+        """Solves a symmetric positive definite linear system with
+        conjugate gradient storing the number of iterations, the relative
+        residual and whether the solve converged in cg_info
+
+        Arguments:
+            A : sparse matrix or LinearOperator
+                n x n coefficents
+            b : array
+                n right hand side
+            tol : float
+                tolerence for conjugate gradient
+            M : sparse matrix or LinearOperator
+                preconditioner approximating the inverse of A
+            x0 : array
+                n initial guess
+        Returns:
+            x : array
+                n solution
+        """
+        n_iter = [0]
+
+        def callback(xk):
+            n_iter[0] += 1
+
+        x, info = cg(A, b, x0=x0, tol=tol, M=M, callback=callback)
+        res = np.linalg.norm(b - A.dot(x)) / np.linalg.norm(b)
+
+        self.cg_info = {"n_iter": n_iter[0], "residual": res, "converged": info == 0}
+        if info != 0:
+            warnings.warn("cg did not converge after {} iterations, relative "
+                          "residual {:.2e}".format(n_iter[0], res))
+
+        return(x)
+
+    def _coal_precond(self, A, precond):
+        """Builds a preconditioner for the sparse coalescent time
+        equations
+
+        Arguments:
+            A : csr_matrix
+                n_wb x n_wb matrix of coefficents
+            precond : str
+                None, "jacobi", "ilu" or "amg"
+        Returns:
+            M : sparse matrix or LinearOperator
+                approximate inverse of A
+        """
+        if precond is None:
+            M = None
+
+        elif precond == "jacobi":
+            M = diags(1. / A.diagonal())
+
+        elif precond == "ilu":
+            # symmetric fill reducing ordering without pivoting
+            ilu = spilu(A.tocsc(), drop_tol=1e-2, permc_spec="MMD_AT_PLUS_A",
+                        diag_pivot_thresh=0., options={"SymmetricMode": True})
+
+            # dropping makes the factors non symmetric so the solve with
+            # them and with their transpose is averaged for cg
+            def matvec(x):
+                return(.5 * (ilu.solve(x) + ilu.solve(x, trans="T")))
+
+            M = LinearOperator(A.shape, matvec=matvec, dtype=np.float64)
+
+        elif precond == "amg":
+            # pair (alpha, beta) belongs to the aggregate of the pair of
+            # aggregates of alpha and beta
+            agg = self._aggregate_demes()
+            n_agg = np.max(agg) + 1
+            triu_idx = np.triu_indices(self.d, 0)
+            agg_a = np.minimum(agg[triu_idx[0]], agg[triu_idx[1]])
+            agg_b = np.maximum(agg[triu_idx[0]], agg[triu_idx[1]])
+            agg_pair = agg_a * n_agg + agg_b
+            _, agg_pair = np.unique(agg_pair, return_inverse=True)
+
+            # piecewise constant prolongation and galerkin coarse matrix
+            P = csr_matrix((np.ones(A.shape[0]), (np.arange(A.shape[0]), agg_pair)))
+            lu = splu(P.T.dot(A).dot(P).tocsc())
+            a_inv = 1. / A.diagonal()
+
+            def matvec(x):
+                # additive jacobi smoothing and coarse correction
+                return(a_inv * x + P.dot(lu.solve(P.T.dot(x))))
+
+            M = LinearOperator(A.shape, matvec=matvec, dtype=np.float64)
+
+        else:
+            raise ValueError("precond must be None, jacobi, ilu or amg")
+
+        return(M)
+
+    def _aggregate_demes(self):
+        """Greedily groups each deme with its not yet grouped neighbors
+        on the graph defined by the habitat
+
+        Returns:
+            agg : array
+                d array of aggregate ids for each deme
+        """
+        l = csr_matrix(self.l)
+        agg = -np.ones(self.d, dtype=np.int64)
+        n_agg = 0
         for i in range(self.d):
-            for j in range(i, self.d):
-                h[i, j] = k
-                h[j, i] = k
-                k += 1
+            if agg[i] == -1:
+                nbrs = l.indices[l.indptr[i]:l.indptr[i + 1]]
+                nbrs = nbrs[agg[nbrs] == -1]
+                agg[nbrs] = n_agg
+                agg[i] = n_agg
+                n_agg += 1
+
+        return(agg)
+
+    def _coal_sylvester(self, tol):
+        """Solves the coalescent time equations L T + T L + diag(c) = J
+        where c = diag(T) for a symmetric graph laplacian. With L = U D U'
+        the Sylvester equation is diagonal in the eigenbasis so
+        T = s (J - U [(U' diag(c) U) / (D_i + D_j)] U') where the null mode
+        of the Kronecker sum is absorbed into the constant s. Requiring
+        diag(T) = s c gives a d x d capacitance system (I + C) c = 1 that
+        is solved by conjugate gradient and s is fixed by the solvability
+        condition sum(diag(T)) = d^2
 
-        # coefficents of coal time equation
-        A = np.zeros((n_wb, n_wb))
+        Arguments:
+            tol : float
+                tolerence for solving the capacitance system
+        Returns:
+            t : array
+                d x d of expected coalescent times between each node
+        """
+        l = self.l.toarray() if issparse(self.l) else np.asarray(self.l)
+        if not np.allclose(l, l.T):
+            raise ValueError("sylvester method requires a symmetric graph laplacian")
 
-        # solution to coal time equation
-        b = np.ones(n_wb)
+        # eigendecomposition of the graph laplacian
+        lam, u = eigh(l)
 
-        # loop of all unique pairs of demes
-        for i in range(n_wb):
+        # inverse of the Kronecker sum eigenvalues excluding the null mode
+        lam_sum = lam[:, None] + lam[None, :]
+        w = np.zeros((self.d, self.d))
+        nz_idx = lam_sum > 1e-10 * np.max(lam_sum)
+        w[nz_idx] = 1. / lam_sum[nz_idx]
 
-            # deme pair for each row
-            alpha, beta = (triu_idx[0][i], triu_idx[1][i])
+        def kron_solve(c):
+            # solves L T + T L = diag(c) in the eigenbasis
+            return(u.dot((u.T * c).dot(u) * w).dot(u.T))
 
-            if alpha == beta:
-                c = h[alpha, beta]
-                A[i, c] += 1.  # add coalescent rate
+        def matvec(c):
+            # diagonal of the Kronecker sum solve for diag(c)
+            y = np.einsum("ij,ij->i", u.dot((u.T * c).dot(u) * w), u)
 
-            # loop over neighbors of deme alpha
-            for gamma in range(self.d):
-                c = h[beta, gamma]
-                A[i, c] += self.l[alpha, gamma]
+            return(c + y)
 
-            # loop over the neighbors of deme beta
-            for gamma in range(self.d):
-                c = h[alpha, gamma]
-                A[i, c] += self.l[beta, gamma]
+        C = LinearOperator((self.d, self.d), matvec=matvec, dtype=np.float64)
 
-        #t = np.empty((self.d, self.d))
-        #t[triu_idx] = np.linalg.solve(A, b)
-        #t = t + t.T - np.diag(np.diag(t))
+        # within deme coalescent times up to a constant
+        c = self._cg(C, np.ones(self.d), tol)
 
-        A_ = csr_matrix(A)
+        # rescale using the solvability condition
+        s = self.d ** 2 / np.sum(c)
+        t = s * (1. - kron_solve(c))
 
-        t_ = cg(A_, b, tol=tol)
-        t = np.empty((self.d, self.d))
-        t[triu_idx] = t_[0]
-        t = t + t.T - np.diag(np.diag(t))
+        # remove round off asymmetry
+        t = (t + t.T) / 2.
 
         return(t)
 
+    def coal_solve(self, b, tol=1e-8, x0=None):
+        """Solves L X + X L' + diag(X) = B for a d x d right hand side
+        with the matrix free operator of the coalescent time equations,
+        e.g. the adjoint equations when differentiating a function of the
+        coalescent times. As the operator is then symmetric this requires
+        a symmetric graph laplacian
+
+        Arguments:
+            b : array
+                d x d right hand side
+            tol : float
+                tolerence for solving linear system using conjugate gradient
+            x0 : array
+                d x d initial guess
+
+        Returns:
+            x : array
+                d x d solution
+        """
+        if not self._is_symmetric(self.l):
+            raise ValueError("coal_solve requires a symmetric graph laplacian")
+
+        A = self._coal_operator()
+        if x0 is not None:
+            x0 = np.ravel(x0)
+
+        x = self._cg(A, np.ravel(b), tol, M=self._coal_jacobi(), x0=x0)
+        x = x.reshape(self.d, self.d)
+
+        return(x)
+
+    def _coal_jacobi(self):
+        """Jacobi preconditioner of the matrix free coalescent time operator
+
+        Returns:
+            M : dia_matrix
+                d^2 x d^2 inverse of the diagonal of the operator
+        """
+        # diagonal of the operator is l[a, a] + l[b, b] + 1{a = b}
+        l_diag = self.l.diagonal()
+        a_diag = l_diag[:, None] + l_diag[None, :] + np.eye(self.d)
+        M = diags(1. / a_diag.ravel())
+
+        return(M)
+
+    def _coal_operator(self):
+        """Linear operator of the coalescent time equations acting on
+        a flattened d x d array of pairwise coalescent times T. Each
+        product costs two multiplications with the graph laplacian and
+        only O(d^2) memory
+
+        Returns:
+            A : LinearOperator
+                d^2 x d^2 operator T -> L T + T L' + diag(T)
+        """
+        diag_idx = np.diag_indices(self.d)
+
+        def matvec(x):
+            t = x.reshape(self.d, self.d)
+
+            # migration of the first and second lineage
+            y = self.l.dot(t) + self.l.dot(t.T).T
+
+            # add coalescent rate to the within deme pairs
+            y[diag_idx] += t[diag_idx]
+
+            return(y.ravel())
+
+        A = LinearOperator((self.d ** 2, self.d ** 2), matvec=matvec,
+                           dtype=np.float64)
+
+        return(A)
+
+    def _coal_matrix(self):
+        """Assembles the sparse coefficent matrix of the coalescent
+        time equations for every unique pair of demes. The row of the
+        pair (alpha, beta) has a coefficent l[alpha, gamma] on the pair
+        (beta, gamma) and l[beta, gamma] on the pair (alpha, gamma) so
+        each non-zero l[a, g] of the graph laplacian contributes to the
+        pairs (a, x) and (x, g) for every deme x. The within deme
+        equations, where both terms coincide, are halved so that the
+        matrix is symmetric whenever the graph laplacian is
+
+        Returns:
+            A : csr_matrix
+                n_wb x n_wb matrix of coefficents where n_wb = d(d+1)/2
+        """
+        # upper tri indicies including diagonal
+        triu_idx = np.triu_indices(self.d, 0)
+
+        # number of within deme equations and between deme equations
+        n_wb = triu_idx[0].shape[0]
+
+        # d x d matrix storing indicies of each pair
+        h = np.zeros((self.d, self.d), dtype=np.int64)
+        h[triu_idx] = np.arange(n_wb)
+        h = h + h.T - np.diag(np.diag(h))
+
+        # non-zero entries of the graph laplacian i.e. neighbors
+        l = coo_matrix(self.l)
+
+        # rows are the pairs (a, x) and cols are the pairs (x, g)
+        rows = h[l.row].ravel()
+        cols = h[l.col].ravel()
+        vals = np.repeat(l.data, self.d)
+
+        # add coalescent rate to the within deme pairs
+        diag = np.diag(h)
+        rows = np.concatenate([rows, diag])
+        cols = np.concatenate([cols, diag])
+        vals = np.concatenate([vals, .5 * np.ones(self.d)])
+
+        # duplicate entries are summed when converting to csr
+        A = coo_matrix((vals, (rows, cols)), shape=(n_wb, n_wb)).tocsr()
+
+        return(A)
+
     def _cov_to_dist(self, sigma):
         """Converts covariance matrix to distance matrix
 
@@ -198,10 +1755,14 @@ class Habitat(object):
                 multiplier of edge weights in plot
         """
         # extract edge weights
-        weights = [self.g[i][j]['m'] for i,j in self.g.edges() if self.g[i][j]['m'] != 0.0]
+        if self.w is not None:
+            w = self.w
+        else:
+            w = np.array([self.g[i][j]['m'] for i,j in self.edges])
+        weights = w[w != 0.0]
 
         # extract non-zero edges
-        edges = [(i,j) for i,j in self.g.edges() if self.g[i][j]['m'] != 0.0]
+        edges = [(i,j) for i,j in self.edges[w != 0.0]]
 
         # draw the habitat
         nx.draw(self.g, pos=self.pos_dict, node_size=node_size,
@@ -212,21 +1773,78 @@ class Habitat(object):
     def plot_migration_matrix(self):
         """Plot the migration matrix as a heatmap
         """
-        plt.imshow(self.m, cmap=cm.viridis)
+        m = self.m.toarray() if issparse(self.m) else self.m
+        plt.imshow(m, cmap=cm.viridis)
         plt.colorbar()
 
     def plot_precision_matrix(self, q):
         """Plots the precision matrix as a heatmap
 
         Arguments:
-            q : array
+            q : array or sparse matrix
                 n x n graph laplacian L or LL'
         """
+        q = q.toarray() if issparse(q) else q
         plt.imshow(q, cmap='seismic', norm=mpl.colors.Normalize(vmin=-np.max(q),
                    vmax=np.max(q)))
         plt.colorbar()
 
 
+class _PermutedLU(object):
+    """Sparse LU of a symmetrically permuted matrix P A P' which solves
+    with A
+
+    Arguments
+    ---------
+    lu : SuperLU
+        factorization of the permuted matrix
+    perm : array
+        permutation of the rows and columns
+    """
+    def __init__(self, lu, perm):
+        self.lu = lu
+        self.perm = perm
+
+    def solve(self, b, trans="N"):
+        x = np.empty(b.shape)
+        x[self.perm] = self.lu.solve(np.asarray(b[self.perm], dtype=np.float64), trans=trans)
+
+        return(x)
+
+
+def pinv_update(g_inv, nodes, delta):
+    """Updates the pseudo inverse G of a symmetric graph laplacian L when
+    L changes by E D E' where E selects k nodes and D is a symmetric k x k
+    matrix with zero row sums, e.g. the change of L when the weights of
+    the edges between the nodes change. As D preserves the null space of
+    L the Woodbury identity applies to the pseudo inverse
+    G - G E D (I + E' G E D)^-1 E' G as long as the habitat stays connected
+
+    Arguments:
+        g_inv : array
+            d x d pseudo inverse of L
+        nodes : array
+            k array of node ids
+        delta : array
+            k x k change D of L between the nodes
+
+    Returns:
+        g_inv : array
+            d x d pseudo inverse of L + E D E'
+    """
+    g_e = g_inv[:, nodes]
+    cap = np.eye(len(nodes)) + g_e[nodes].dot(delta)
+    if np.linalg.cond(cap) > 1e12:
+        raise np.linalg.LinAlgError("update makes the graph laplacian singular")
+
+    g_inv = g_inv - g_e.dot(delta).dot(np.linalg.solve(cap, g_e.T))
+
+    # remove round off asymmetry
+    g_inv = (g_inv + g_inv.T) / 2.
+
+    return(g_inv)
+
+
 class TriangularLattice(Habitat):
     """Class for a habitat that is a triangular latttice
 
@@ -240,11 +1858,12 @@ class TriangularLattice(Habitat):
     Attributes
     ----------
     g : nx directed graph
-        directed graph object storing the Habitat
+        directed graph object storing the Habitat which is
+        built on first access
     d : int
         number of nodes in the graph
-    m : array
-        d x d matrix storing the migration
+    m : csr_matrix
+        d x d sparse matrix storing the migration
         rates
     r : int
         number of rows in the latttice
@@ -256,6 +1875,12 @@ class TriangularLattice(Habitat):
         array of node ids
     s : array
         d x 2 array of spatial positions
+    edges : array
+        E x 2 array of directed edges
+    edge_mid : array
+        E x 2 array of spatial positions of the edge midpoints
+    w : array
+        E array of edge weights
     """
     def __init__(self, r, c):
         # inherits from Habitat
@@ -270,23 +1895,26 @@ class TriangularLattice(Habitat):
         # number of nodes
         self.d = self.r * self.c
 
-        # create the graph
-        self.g = nx.generators.lattice.triangular_lattice_graph(r - 1, 2 * c - 2, with_positions=True)
+        # node i, j is in row i and col j and every other row is shifted
+        i, j = np.divmod(np.arange(self.d), self.c)
 
-        # make node ids ints
-        self.g = nx.convert_node_labels_to_integers(self.g)
+        # array of node ids
+        self.v = np.arange(self.d)
 
-        # convert to directed graph
-        self.g = self.g.to_directed()
+        # array of spatial positions
+        self.s = np.column_stack([j + .5 * (i % 2), (np.sqrt(3) / 2) * i])
 
-        # dictionary of positions
-        self.pos_dict = nx.get_node_attributes(self.g, "pos")
+        # edges within rows, between rows and along the diagonals
+        k = np.arange(self.d).reshape(self.r, self.c)
+        k_even, k_odd = k[:-1:2], k[1:-1:2]
+        edges = np.vstack([np.column_stack([k[:, :-1].ravel(), k[:, 1:].ravel()]),
+                           np.column_stack([k[:-1].ravel(), k[1:].ravel()]),
+                           np.column_stack([k_odd[:, :-1].ravel(), k[2::2, 1:].ravel()]),
+                           np.column_stack([k_even[:, 1:].ravel(), k[1::2, :-1].ravel()])])
 
-        # array of node ids
-        self.v = np.array(list(self.g.nodes()))
+        # arrays of edges
+        self._init_edges(edges)
 
-        # array of spatial positions
-        self.s = np.array(list(self.pos_dict.values()))
 
 class SquareLattice(Habitat):
     """Class for a habitat that is a square latttice
@@ -301,11 +1929,12 @@ class SquareLattice(Habitat):
     Attributes
     ----------
     g : nx directed graph
-        directed graph object storing the Habitat
+        directed graph object storing the Habitat which is
+        built on first access
     d : int
         number of nodes in the graph
-    m : array
-        d x d matrix storing the migration
+    m : csr_matrix
+        d x d sparse matrix storing the migration
         rates
     r : int
         number of rows in the latttice
@@ -317,6 +1946,12 @@ class SquareLattice(Habitat):
         array of node ids
     s : array
         d x 2 array of spatial positions
+    edges : array
+        E x 2 array of directed edges
+    edge_mid : array
+        E x 2 array of spatial positions of the edge midpoints
+    w : array
+        E array of edge weights
     """
     def __init__(self, r, c):
 
@@ -332,28 +1967,52 @@ class SquareLattice(Habitat):
         # number of nodes
         self.d = self.r * self.c
 
-        # create the graph
-        self.g = nx.grid_2d_graph(self.r, self.c)
+        # node i, j is in row i and col j
+        i, j = np.divmod(np.arange(self.d), self.c)
+
+        # array of node ids
+        self.v = np.arange(self.d)
+
+        # array of spatial positions
+        self.s = np.column_stack([i, j]).astype(np.float64)
 
-        # dictionary of positions
-        self.pos_dict = {}
-        for i,node in enumerate(self.g.nodes):
-            self.g.nodes[node]["pos"] = node
-            self.pos_dict[i] = node
+        # edges within rows and within cols
+        k = np.arange(self.d).reshape(self.r, self.c)
+        edges = np.vstack([np.column_stack([k[:-1].ravel(), k[1:].ravel()]),
+                           np.column_stack([k[:, :-1].ravel(), k[:, 1:].ravel()])])
 
-        #nx.set_node_attributes(self.g, "pos", self.pos_dict)
+        # arrays of edges
+        self._init_edges(edges)
 
-        # make node ids ints
-        self.g = nx.convert_node_labels_to_integers(self.g)
+    def _kron_factors(self):
+        """Chain graph laplacians along the cols and rows of the lattice if
+        the migration rate of each edge only depends on its position along
+        the chain so that L = A x I + I x B
 
-        # convert to directed graph
-        self.g = self.g.to_directed()
+        Returns:
+            factors : tuple
+                r x r laplacian A and c x c laplacian B or None if migration
+                is not separable
+        """
+        if self.l is None:
+            return(None)
 
-        # array of node ids
-        self.v = np.array(list(self.g.nodes()))
+        l = csr_matrix(self.l)
 
-        # array of spatial positions
-        self.s = np.array(list(self.pos_dict.values()))
+        # nodes down the first col and along the first row
+        k_col = np.arange(self.r) * self.c
+        k_row = np.arange(self.c)
+
+        a = l[k_col][:, k_col].toarray()
+        a = a - np.diag(np.sum(a, axis=1))
+        b = l[k_row][:, k_row].toarray()
+        b = b - np.diag(np.sum(b, axis=1))
+
+        l_kron = kron(a, identity(self.c)) + kron(identity(self.r), b)
+        if abs(l_kron - l).max() > 1e-12 * max(abs(l).max(), 1.):
+            return(None)
+
+        return((a, b))
 
 
 class Line(Habitat):
@@ -367,11 +2026,12 @@ class Line(Habitat):
     Attributes
     ----------
     g : nx directed graph
-        directed graph object storing the Habitat
+        directed graph object storing the Habitat which is
+        built on first access
     d : int
         number of nodes in the graph
-    m : array
-        d x d matrix storing the migration
+    m : csr_matrix
+        d x d sparse matrix storing the migration
         rates
     pos_dict : dict
         dictionary of spatial positions
@@ -379,6 +2039,12 @@ class Line(Habitat):
         array of node ids
     s : array
         d x 2 array of spatial positions
+    edges : array
+        E x 2 array of directed edges
+    edge_mid : array
+        E x 2 array of spatial positions of the edge midpoints
+    w : array
+        E array of edge weights
     """
     def __init__(self, d):
 
@@ -388,28 +2054,17 @@ class Line(Habitat):
         # number of nodes
         self.d = d
 
-        # create the graph
-        self.g = nx.grid_graph([self.d])
-
-        # dictionary of positions
-        self.pos_dict = {}
-        for i,node in enumerate(self.g.nodes):
-            self.g.nodes[node]["pos"] = (node, 0.)
-            self.pos_dict[i] = (node, 0.)
-
-        #nx.set_node_attributes(self.g, "pos", self.pos_dict)
-
-        # make node ids ints
-        self.g = nx.convert_node_labels_to_integers(self.g)
-
-        # convert to directed graph
-        self.g = self.g.to_directed()
-
         # array of node ids
-        self.v = np.array(list(self.g.nodes()))
+        self.v = np.arange(self.d)
 
         # array of spatial positions
-        self.s = np.array(list(self.pos_dict.values()))
+        self.s = np.column_stack([self.v, np.zeros(self.d)]).astype(np.float64)
+
+        # edges between consecutive nodes
+        edges = np.column_stack([self.v[:-1], self.v[1:]])
+
+        # arrays of edges
+        self._init_edges(edges)
 
 
 class Circle(Habitat):
@@ -423,11 +2078,12 @@ class Circle(Habitat):
     Attributes
     ----------
     g : nx directed graph
-        directed graph object storing the Habitat
+        directed graph object storing the Habitat which is
+        built on first access
     d : int
         number of nodes in the graph
-    m : array
-        d x d matrix storing the migration
+    m : csr_matrix
+        d x d sparse matrix storing the migration
         rates
     pos_dict : dict
         dictionary of spatial positions
@@ -435,6 +2091,12 @@ class Circle(Habitat):
         array of node ids
     s : array
         d x 2 array of spatial positions
+    edges : array
+        E x 2 array of directed edges
+    edge_mid : array
+        E x 2 array of spatial positions of the edge midpoints
+    w : array
+        E array of edge weights
     """
     def __init__(self, d):
 
@@ -443,20 +2105,17 @@ class Circle(Habitat):
         # number of nodes
         self.d = d
 
-        # create the graph
-        self.g = nx.cycle_graph(d)
-
-        # make node ids ints
-        self.g = nx.convert_node_labels_to_integers(self.g)
-
-        # convert to directed graph
-        self.g = self.g.to_directed()
+        # array of node ids
+        self.v = np.arange(self.d)
 
-        # dictionary of positions
-        self.pos_dict = nx.circular_layout(self.g)
+        # array of spatial positions evenly spaced on the unit circle
+        theta = (np.linspace(0, 1, self.d + 1)[:-1] * 2 * np.pi).astype(np.float32)
+        s = np.column_stack([np.cos(theta), np.sin(theta)]).astype(np.float64)
+        s = s - np.mean(s, axis=0)
+        self.s = s / np.max(np.abs(s))
 
-        # array of node ids
-        self.v = np.array(list(self.g.nodes()))
+        # edges between consecutive nodes
+        edges = np.column_stack([self.v, np.roll(self.v, -1)])
 
-        # array of spatial positions
-        self.s = np.array(list(self.pos_dict.values()))
+        # arrays of edges
+        self._init_edges(edges)
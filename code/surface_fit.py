@@ -0,0 +1,280 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from scipy.optimize import minimize
+from scipy.sparse import csr_matrix, diags
+
+
+class SurfaceFit(object):
+    """Class for fitting the edge weights of a habitat to an observed
+    matrix of genetic distances between demes. The log weights of the
+    undirected edges are optimized with bounded L-BFGS and the migration
+    matrix is set to the weights directly, see set_edge_weights. Gradients
+    of the resistance or coalescent distances with respect to all edge
+    weights are computed with one adjoint solve
+
+    Arguments
+    ---------
+    hab : Habitat
+        habitat object whose edges are stored in both directions, see
+        _init_edges
+    d_obs : array
+        k x k observed genetic distances between the demes in nodes
+    nodes : array
+        k array of node ids of the sampled demes defaults to all nodes
+    dist : str
+        "resistance" for the resistance distance of L or "coal" for the
+        expected coalescent times
+    lamb : float
+        weight of the smoothness penalty on the log weights of
+        neighboring edges
+    w_bounds : tuple
+        lower and upper bound of the edge weights
+    affine : bool
+        if True the distances are fit up to an intercept and slope
+    tol : float
+        tolerence of the coalescent time solves
+
+    Attributes
+    ----------
+    hab : Habitat
+        habitat object
+    d_obs : array
+        k x k observed genetic distances between the demes in nodes
+    nodes : array
+        k array of node ids of the sampled demes
+    dist : str
+        "resistance" or "coal"
+    lamb : float
+        weight of the smoothness penalty
+    w_bounds : tuple
+        lower and upper bound of the edge weights
+    affine : bool
+        if True the distances are fit up to an intercept and slope
+    tol : float
+        tolerence of the coalescent time solves
+    n_e : int
+        number of undirected edges
+    l_line : csr_matrix
+        n_e x n_e graph laplacian of the line graph connecting edges that
+        share a node
+    w : array
+        n_e fitted weights of the undirected edges
+    coef : tuple
+        fitted intercept and slope
+    opt_result : OptimizeResult
+        output of the optimizer
+    """
+    def __init__(self, hab, d_obs, nodes=None, dist="resistance", lamb=0.,
+                 w_bounds=(1e-4, 1.), affine=True, tol=1e-8):
+
+        # habitat object
+        self.hab = hab
+
+        # observed distances
+        self.d_obs = np.asarray(d_obs, dtype=np.float64)
+
+        # sampled demes
+        self.nodes = np.arange(hab.d) if nodes is None else np.asarray(nodes)
+
+        # distance to fit
+        if dist not in ("resistance", "coal"):
+            raise ValueError("dist must be resistance or coal")
+        self.dist = dist
+
+        # smoothness penalty
+        self.lamb = lamb
+
+        # bounds of the edge weights
+        self.w_bounds = w_bounds
+
+        # fit intercept and slope
+        self.affine = affine
+
+        # tolerence of the coalescent time solves
+        self.tol = tol
+
+        # undirected edges are the first half of the directed edges
+        self.n_e = hab.edges.shape[0] // 2
+        if not np.array_equal(hab.edges[self.n_e:], hab.edges[:self.n_e, ::-1]):
+            raise ValueError("habitat edges must be stored in both directions")
+        self._u = hab.edges[:self.n_e, 0]
+        self._v = hab.edges[:self.n_e, 1]
+
+        # pairs of sampled demes
+        self._triu_idx = np.triu_indices(self.nodes.shape[0], 1)
+        self._y = self.d_obs[self._triu_idx]
+
+        self.l_line = self._line_lapl()
+
+        # fitted weights
+        self.w = None
+
+        # fitted intercept and slope
+        self.coef = None
+
+        # output of the optimizer
+        self.opt_result = None
+
+        # coalescent times and adjoint of the last evaluation which are
+        # the initial guesses of the next solves
+        self._t = None
+        self._lam = None
+
+    def _line_lapl(self):
+        """Computes the graph laplacian of the line graph of the habitat
+        where two undirected edges are neighbors if they share a node
+
+        Returns:
+            l_line : csr_matrix
+                n_e x n_e graph laplacian
+        """
+        e_idx = np.arange(self.n_e)
+
+        # unsigned node by edge incidence matrix
+        b = csr_matrix((np.ones(2 * self.n_e), (np.r_[self._u, self._v], np.r_[e_idx, e_idx])),
+                       shape=(self.hab.d, self.n_e))
+
+        a = b.T.dot(b) - 2. * diags(np.ones(self.n_e))
+        a.eliminate_zeros()
+        l_line = (diags(np.asarray(a.sum(axis=1)).ravel()) - a).tocsr()
+
+        return(l_line)
+
+    def set_weights(self, w):
+        """Sets the migration rates of the habitat to the weights of the
+        undirected edges
+
+        Arguments:
+            w : array
+                n_e weights
+        """
+        self.hab.set_edge_weights(np.r_[w, w], normalize=False)
+
+    def loss(self, theta):
+        """Computes the least squares loss between the observed and fitted
+        distances plus the smoothness penalty and its gradient
+
+        Arguments:
+            theta : array
+                n_e log weights of the undirected edges
+
+        Returns:
+            f : float
+                loss
+            grad : array
+                n_e gradient with respect to theta
+        """
+        w = np.exp(theta)
+        self.set_weights(w)
+
+        if self.dist == "resistance":
+            # columns of the pseudo inverse for the sampled demes
+            y_cols = self.hab.pinv_cols(self.hab.l, self.nodes)
+            x = y_cols[self.nodes]
+            x_diag = np.diag(x)
+            d_fit = (x_diag[:, None] + x_diag[None, :] - 2. * x)[self._triu_idx]
+        else:
+            t = self.hab.coal_dist(tol=self.tol, x0=self._t)
+            self._t = t
+            d_fit = t[np.ix_(self.nodes, self.nodes)][self._triu_idx]
+
+        a, b = self._coef(d_fit)
+        res = a + b * d_fit - self._y
+        f = .5 * np.sum(res ** 2)
+
+        # derivative of the loss with respect to each fitted distance
+        k = self.nodes.shape[0]
+        psi = np.zeros((k, k))
+        psi[self._triu_idx] = b * res
+        psi = psi + psi.T
+
+        if self.dist == "resistance":
+            # dR_ij / dw_e = -(b_e' G (e_i - e_j))^2 summed over the pairs
+            # gives -z_e' (diag(psi 1) - psi) z_e with z_e = b_e' G E
+            z = y_cols[self._u] - y_cols[self._v]
+            psi_lapl = np.diag(np.sum(psi, axis=1)) - psi
+            grad_w = -np.sum(z.dot(psi_lapl) * z, axis=1)
+        else:
+            # adjoint solve with the coalescent time operator, half of the
+            # derivative goes to each of T_ij and T_ji
+            psi_full = np.zeros((self.hab.d, self.hab.d))
+            np.add.at(psi_full, (self.nodes[:, None], self.nodes[None, :]), psi / 2.)
+            lam = self.hab.coal_solve(psi_full, tol=self.tol, x0=self._lam)
+            lam = (lam + lam.T) / 2.
+            self._lam = lam
+
+            # dA / dw_e T = b_e b_e' T + T b_e b_e' so the gradient is
+            # -2 (lam b_e)' (T b_e)
+            grad_w = -2. * np.sum((lam[:, self._u] - lam[:, self._v]) *
+                                  (t[:, self._u] - t[:, self._v]), axis=0)
+
+        grad = grad_w * w
+
+        # smoothness penalty
+        l_theta = self.l_line.dot(theta)
+        f = f + .5 * self.lamb * theta.dot(l_theta)
+        grad = grad + self.lamb * l_theta
+
+        return(f, grad)
+
+    def _coef(self, d_fit):
+        """Least squares intercept and slope of the observed distances
+        regressed on the fitted distances. As these minimize the loss
+        the gradient with respect to the weights holds them fixed
+
+        Arguments:
+            d_fit : array
+                fitted distances of the pairs of sampled demes
+
+        Returns:
+            coef : tuple
+                intercept and slope
+        """
+        if not self.affine:
+            return((0., 1.))
+
+        z = np.column_stack([np.ones(d_fit.shape[0]), d_fit])
+        coef = np.linalg.lstsq(z, self._y, rcond=None)[0]
+
+        return((coef[0], coef[1]))
+
+    def fit(self, w0=None, maxiter=500):
+        """Fits the edge weights with bounded L-BFGS and sets the migration
+        rates of the habitat to the fitted weights
+
+        Arguments:
+            w0 : array
+                n_e initial weights of the undirected edges defaults to the
+                geometric mean of the bounds
+            maxiter : int
+                maximum number of iterations
+
+        Returns:
+            w : array
+                n_e fitted weights of the undirected edges
+        """
+        log_bounds = np.log(self.w_bounds)
+        if w0 is None:
+            theta0 = np.full(self.n_e, np.mean(log_bounds))
+        else:
+            theta0 = np.log(w0)
+
+        self.opt_result = minimize(self.loss, theta0, jac=True, method="L-BFGS-B",
+                                   bounds=[tuple(log_bounds)] * self.n_e,
+                                   options={"maxiter": maxiter})
+
+        self.w = np.exp(self.opt_result.x)
+        self.set_weights(self.w)
+
+        if self.dist == "resistance":
+            d_fit = self.hab.rw_dist(self.hab.l, nodes=self.nodes)[self._triu_idx]
+        else:
+            t = self.hab.coal_dist(tol=self.tol)
+            d_fit = t[np.ix_(self.nodes, self.nodes)][self._triu_idx]
+        self.coef = self._coef(d_fit)
+
+        return(self.w)
@@ -0,0 +1,300 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from habitat import pinv_update
+from surface_fit import SurfaceFit
+
+
+class SurfaceMCMC(SurfaceFit):
+    """Class for sampling the posterior of the edge weights of a habitat
+    given an observed matrix of genetic distances between demes with a
+    Metropolis random walk over the log weights of the undirected edges.
+    The observed distances are modeled as the resistance distances plus
+    gaussian noise and the prior is uniform within w_bounds times the
+    smoothness penalty of SurfaceFit. Each proposal changes the weight of
+    a single edge which changes the graph laplacian by a rank one matrix
+    so the pseudo inverse G is updated with pinv_update instead of being
+    recomputed. Evaluating a proposal only updates the block of G for the
+    k sampled demes and the two nodes of the edge which costs O(k^2) and
+    accepting it updates all of G which costs O(d^2). Samples are streamed
+    to a binary trace file on disk every thin iterations which replaces
+    the trace of a previous run of the chain
+
+    Arguments
+    ---------
+    hab : Habitat
+        habitat object whose edges are stored in both directions
+    d_obs : array
+        k x k observed genetic distances between the demes in nodes
+    trace_path : str
+        prefix of the trace files
+    nodes : array
+        k array of node ids of the sampled demes defaults to all nodes
+    sigma2 : float
+        variance of the noise of the observed distances
+    lamb : float
+        weight of the smoothness penalty on the log weights of
+        neighboring edges
+    w_bounds : tuple
+        lower and upper bound of the edge weights
+    affine : bool
+        if True the intercept and slope of the distances are profiled
+    step : float
+        standard deviation of the proposals of the log weights
+    thin : int
+        number of iterations between samples written to the trace
+    refresh : int
+        number of accepted proposals after which G is recomputed to
+        remove accumulated round off error
+
+    Attributes
+    ----------
+    trace_path : str
+        prefix of the trace files
+    sigma2 : float
+        variance of the noise of the observed distances
+    step : float
+        standard deviation of the proposals of the log weights
+    thin : int
+        number of iterations between samples written to the trace
+    refresh : int
+        number of accepted proposals after which G is recomputed
+    acc_rate : list
+        acceptance rate of each chain of the last run
+    """
+    def __init__(self, hab, d_obs, trace_path, nodes=None, sigma2=1., lamb=0.,
+                 w_bounds=(1e-4, 1.), affine=False, step=.1, thin=10, refresh=1000):
+
+        super(SurfaceMCMC, self).__init__(hab, d_obs, nodes=nodes, dist="resistance",
+                                          lamb=lamb, w_bounds=w_bounds, affine=affine)
+
+        # prefix of the trace files
+        self.trace_path = trace_path
+
+        # noise variance
+        self.sigma2 = sigma2
+
+        # proposal standard deviation
+        self.step = step
+
+        # thinning of the trace
+        self.thin = thin
+
+        # accepted proposals between full recomputations of G
+        self.refresh = refresh
+
+        # acceptance rate of each chain
+        self.acc_rate = None
+
+    def trace_file(self, chain):
+        """Path of the trace file of a chain
+
+        Arguments:
+            chain : int
+                chain id
+
+        Returns:
+            f : str
+                path of the trace file
+        """
+        return("{}.chain{}.bin".format(self.trace_path, chain))
+
+    def trace(self, chain=0):
+        """Loads the trace of a chain
+
+        Arguments:
+            chain : int
+                chain id
+
+        Returns:
+            trace : array
+                n x (n_e + 1) memory mapped array of the log weights and the
+                log posterior of each sample
+        """
+        trace = np.memmap(self.trace_file(chain), dtype=np.float64, mode="r")
+
+        return(trace.reshape(-1, self.n_e + 1))
+
+    def _pinv(self, theta):
+        """Computes the pseudo inverse of the graph laplacian
+
+        Arguments:
+            theta : array
+                n_e log weights of the undirected edges
+
+        Returns:
+            g_inv : array
+                d x d pseudo inverse of L
+        """
+        self.set_weights(np.exp(theta))
+        g_inv = self.hab.pinv_cols(self.hab.l, np.arange(self.hab.d))
+
+        return(g_inv)
+
+    def _log_lik(self, x):
+        """Gaussian log likelihood of the observed distances
+
+        Arguments:
+            x : array
+                k x k block of the pseudo inverse for the sampled demes
+
+        Returns:
+            log_lik : float
+                log likelihood up to a constant
+        """
+        x_diag = np.diag(x)
+        d_fit = (x_diag[:, None] + x_diag[None, :] - 2. * x)[self._triu_idx]
+        a, b = self._coef(d_fit)
+        log_lik = -.5 * np.sum((a + b * d_fit - self._y) ** 2) / self.sigma2
+
+        return(log_lik)
+
+    def sample(self, n_iter, w0=None, seed=0, chain=0):
+        """Runs a single chain and writes its samples to the trace file,
+        overwriting the trace of a previous run of the chain. The migration
+        rates of the habitat are set to the weights of the last state of the
+        chain
+
+        Arguments:
+            n_iter : int
+                number of iterations
+            w0 : array
+                n_e initial weights defaults to the geometric mean of the
+                bounds
+            seed : int
+                seed of the random state
+            chain : int
+                chain id
+
+        Returns:
+            acc_rate : float
+                fraction of accepted proposals
+        """
+        rng = np.random.RandomState(seed)
+        log_bounds = np.log(self.w_bounds)
+        sel = self.nodes
+
+        if w0 is None:
+            theta = np.full(self.n_e, np.mean(log_bounds))
+        else:
+            theta = np.log(np.asarray(w0, dtype=np.float64))
+
+        g_inv = self._pinv(theta)
+        log_lik = self._log_lik(g_inv[np.ix_(sel, sel)])
+        l_theta = self.l_line.dot(theta)
+        log_prior = -.5 * self.lamb * theta.dot(l_theta)
+        l_line_diag = self.l_line.diagonal()
+
+        # the nodes of the edge are appended to the sampled demes
+        k = sel.shape[0]
+        sub_idx = np.r_[sel, 0, 0]
+        bb = np.array([[1., -1.], [-1., 1.]])
+
+        f = self.trace_file(chain)
+        if os.path.exists(f):
+            os.remove(f)
+
+        n_acc = 0
+        buf = []
+        for it in range(n_iter):
+            e = rng.randint(self.n_e)
+            delta = rng.normal(0., self.step)
+            theta_e = theta[e] + delta
+
+            if log_bounds[0] <= theta_e <= log_bounds[1]:
+                u, v = self._u[e], self._v[e]
+
+                # L changes by dw b b' with b = e_u - e_v
+                dw = np.exp(theta_e) - np.exp(theta[e])
+                sub_idx[k:] = u, v
+                try:
+                    x = pinv_update(g_inv[np.ix_(sub_idx, sub_idx)], [k, k + 1], dw * bb)
+                except np.linalg.LinAlgError:
+                    x = None
+
+                if x is not None:
+                    log_lik_p = self._log_lik(x[:k, :k])
+                    log_prior_p = log_prior - .5 * self.lamb * (2. * delta * l_theta[e] +
+                                                                delta ** 2 * l_line_diag[e])
+
+                    log_acc = log_lik_p + log_prior_p - log_lik - log_prior
+                    if np.log(rng.uniform()) < log_acc:
+                        theta[e] = theta_e
+                        l_theta = l_theta + delta * self.l_line[:, e].toarray().ravel()
+                        log_lik, log_prior = log_lik_p, log_prior_p
+                        n_acc += 1
+
+                        if n_acc % self.refresh == 0:
+                            g_inv = self._pinv(theta)
+                        else:
+                            g_inv = pinv_update(g_inv, [u, v], dw * bb)
+
+            if (it + 1) % self.thin == 0:
+                buf.append(np.r_[theta, log_lik + log_prior])
+
+            # stream the samples to disk
+            if len(buf) == 100 or (it == n_iter - 1 and len(buf) > 0):
+                with open(f, "ab") as fh:
+                    np.asarray(buf).tofile(fh)
+                buf = []
+
+        self.set_weights(np.exp(theta))
+        acc_rate = n_acc / n_iter
+
+        return(acc_rate)
+
+    def run(self, n_iter, n_chains=4, seed=0, w0=None, processes=None):
+        """Runs independent chains in a process pool
+
+        Arguments:
+            n_iter : int
+                number of iterations of each chain
+            n_chains : int
+                number of chains
+            seed : int
+                seed of the random state drawing the seed of each chain
+            w0 : array
+                n_e initial weights
+            processes : int
+                number of worker processes defaults to the number of cpus
+
+        Returns:
+            acc_rate : list
+                acceptance rate of each chain
+        """
+        seeds = np.random.RandomState(seed).randint(2 ** 31 - 1, size=n_chains)
+
+        # factorizations cached on the habitat are not sent to the workers,
+        # see Habitat.__getstate__
+        args = [(self, n_iter, w0, seeds[c], c) for c in range(n_chains)]
+        pool = Pool(processes)
+        try:
+            self.acc_rate = pool.map(_sample_chain, args)
+        finally:
+            pool.close()
+            pool.join()
+
+        return(self.acc_rate)
+
+
+def _sample_chain(args):
+    """Runs a chain in a worker process
+
+    Arguments:
+        args : tuple
+            sampler, number of iterations, initial weights, seed and chain id
+
+    Returns:
+        acc_rate : float
+            fraction of accepted proposals
+    """
+    sampler, n_iter, w0, seed, chain = args
+    acc_rate = sampler.sample(n_iter, w0=w0, seed=seed, chain=chain)
+
+    return(acc_rate)
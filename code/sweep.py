@@ -0,0 +1,247 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import copy
+import itertools
+from multiprocessing import Pool
+
+import numpy as np
+
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import splu
+
+
+class SurfaceSweep(object):
+    """Class for evaluating distances between demes for many migration
+    surfaces over the same habitat. The habitat, its edge arrays and the
+    sparsity pattern of its graph laplacian are shared by all surfaces so
+    the fill reducing ordering of the grounded graph laplacian is computed
+    once from the first surface and reused by the factorizations of all
+    others, see Habitat.perm. Surfaces are evaluated in parallel in a
+    process pool and the results are collected into a structured array
+    with one row per surface
+
+    Arguments
+    ---------
+    hab : Habitat
+        habitat object with edge arrays
+    nodes : array
+        k array of node ids to compute distances between defaults to all
+        nodes
+    queries : tuple
+        distances to compute for each surface any of "resistance" the
+        random walk distance of L, "rw" the random walk distance of LL',
+        "coal" the expected coalescent times and "commute" the commute
+        times
+    metrics : dict
+        summary metrics to compute for each surface mapping a name to a
+        module level function of the habitat returning a scalar or array
+        of fixed shape
+    normalize : bool
+        see set_edge_weights
+    tol : float
+        tolerence of the coalescent time solves
+
+    Attributes
+    ----------
+    hab : Habitat
+        habitat object
+    nodes : array
+        k array of node ids to compute distances between
+    queries : tuple
+        distances to compute for each surface
+    metrics : dict
+        summary metrics to compute for each surface
+    normalize : bool
+        see set_edge_weights
+    tol : float
+        tolerence of the coalescent time solves
+    params : array
+        structured array of the parameters of each surface of the last grid
+    results : array
+        structured array of the distances and metrics of each surface of
+        the last run
+    """
+    def __init__(self, hab, nodes=None, queries=("resistance",), metrics=None,
+                 normalize=True, tol=1e-8):
+
+        # habitat object
+        self.hab = hab
+
+        # nodes to compute distances between
+        self.nodes = np.arange(hab.d) if nodes is None else np.asarray(nodes)
+
+        # distances to compute
+        for query in queries:
+            if query not in ("resistance", "rw", "coal", "commute"):
+                raise ValueError("queries must be resistance, rw, coal or commute")
+        self.queries = tuple(queries)
+
+        # summary metrics
+        self.metrics = {} if metrics is None else metrics
+
+        # normalize edge weights
+        self.normalize = normalize
+
+        # tolerence of the coalescent time solves
+        self.tol = tol
+
+        # parameters of the surfaces
+        self.params = None
+
+        # results of the last run
+        self.results = None
+
+    def grid(self, func, **params):
+        """Computes the edge weights of the surfaces over a grid of
+        parameters, e.g. m_min and m_max of a barrier
+
+        Arguments:
+            func : callable
+                function of the habitat and keyword parameters returning an
+                E array of edge weights
+            params : lists
+                values of each parameter
+
+        Returns:
+            weights : array
+                n x E array of edge weights of each combination of the
+                parameters
+        """
+        names = sorted(params)
+        combs = list(itertools.product(*[params[name] for name in names]))
+
+        self.params = np.array(combs, dtype=[(name, np.float64) for name in names])
+        weights = np.array([func(self.hab, **dict(zip(names, comb))) for comb in combs])
+
+        return(weights)
+
+    def _ordering(self, w):
+        """Fill reducing ordering of the grounded graph laplacian which only
+        depends on its sparsity pattern so it is computed once
+
+        Arguments:
+            w : array
+                E array of edge weights of any surface
+
+        Returns:
+            perm : array
+                d - 1 permutation of the grounded nodes
+        """
+        self.hab.perm = None
+        self.hab.set_edge_weights(w, normalize=self.normalize)
+        lu = splu(csc_matrix(self.hab.l)[:-1, :-1].tocsc(), permc_spec="MMD_AT_PLUS_A",
+                  diag_pivot_thresh=0., options={"SymmetricMode": True})
+
+        # perm_c maps the original to the permuted position
+        perm = np.argsort(lu.perm_c)
+
+        return(perm)
+
+    def evaluate(self, w):
+        """Computes the distances and metrics of one surface
+
+        Arguments:
+            w : array
+                E array of edge weights
+
+        Returns:
+            res : list
+                distances and metrics in the order of the result fields
+        """
+        hab = self.hab
+        hab.set_edge_weights(w, normalize=self.normalize)
+
+        res = []
+        for query in self.queries:
+            if query == "resistance":
+                r = hab.rw_dist(hab.l, nodes=self.nodes)
+            elif query == "rw":
+                r = hab.rw_dist(hab.ll, nodes=self.nodes)
+            elif query == "coal":
+                r = hab.coal_dist(tol=self.tol)[np.ix_(self.nodes, self.nodes)]
+            else:
+                r = hab.commute_dist(nodes=self.nodes)
+            res.append(r)
+
+        for name in sorted(self.metrics):
+            res.append(np.asarray(self.metrics[name](hab), dtype=np.float64))
+
+        return(res)
+
+    def run(self, weights, processes=None, chunksize=1):
+        """Evaluates each surface in a process pool
+
+        Arguments:
+            weights : array
+                n x E array of edge weights of each surface
+            processes : int
+                number of worker processes defaults to the number of cpus
+                and 1 evaluates the surfaces in this process
+            chunksize : int
+                number of surfaces sent to a worker at a time
+
+        Returns:
+            results : array
+                n structured array with a k x k field for each query and a
+                field for each metric
+        """
+        weights = np.asarray(weights, dtype=np.float64)
+
+        # the surfaces are set on a copy of the habitat without its cached
+        # factorizations, see Habitat.__getstate__
+        sweep = copy.copy(self)
+        sweep.hab = copy.copy(self.hab)
+
+        # the ordering is shared by the factorizations of all surfaces
+        sweep.hab.perm = sweep._ordering(weights[0])
+
+        if processes == 1:
+            out = [sweep.evaluate(w) for w in weights]
+        else:
+            pool = Pool(processes, initializer=_init_worker, initargs=(sweep,))
+            try:
+                out = pool.map(_evaluate_surface, weights, chunksize)
+            finally:
+                pool.close()
+                pool.join()
+
+        names = list(self.queries) + sorted(self.metrics)
+        dtype = [(name, np.float64, np.shape(x)) for name, x in zip(names, out[0])]
+        self.results = np.zeros(weights.shape[0], dtype=dtype)
+        for i, res in enumerate(out):
+            self.results[i] = tuple(res)
+
+        return(self.results)
+
+
+# sweep object of the worker process
+_sweep = None
+
+
+def _init_worker(sweep):
+    """Stores the sweep object once per worker process
+
+    Arguments:
+        sweep : SurfaceSweep
+            sweep object
+    """
+    global _sweep
+    _sweep = sweep
+
+
+def _evaluate_surface(w):
+    """Evaluates a surface in a worker process
+
+    Arguments:
+        w : array
+            E array of edge weights
+
+    Returns:
+        res : list
+            distances and metrics of the surface
+    """
+    res = _sweep.evaluate(w)
+
+    return(res)